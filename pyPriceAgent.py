@@ -57,8 +57,10 @@
 # The "tickers.txt" file lists the stocks, one per line, trading-view full-names.
 # The "bets.json" file is created to track any reminder bets you place.
 # The "caches" directory holds API request-results etc.
-# The "history" directory holds our daily price-history for each stock
-# Both dirs must be writeable, all the data is just JSON dumped into files.
+# The "history" directory holds our daily price-history for each stock,
+# as numpy columns (time,open,high,low,close,volume) that we memory-map.
+# Old JSON histories can be converted with --migrate-history
+# Both dirs must be writeable, the rest of the data is just JSON dumped into files.
 #
 # You may adjust the default four MA/EMA values in the tickers.txt
 # file, with 4 or 8 numbers separated by spaces after the
@@ -91,32 +93,187 @@
 #
 # See copious comments below these imports...
 
+import time
+startupTime = time.time()
 import os, sys, math, random
 import getopt
 import operator
-import smtplib
-import requests
-import time
 import hashlib
-from datetime import date, datetime
-import dateutil.parser
+import zlib
+import importlib
+import atexit
+import threading
+import multiprocessing
+import itertools
+import copy
+import io
+import array
+from urllib.parse import urlparse, parse_qsl
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
 import json
-from tabulate import tabulate
-import pandas as pd
 import numpy as np
-
-import matplotlib
-matplotlib.use('Agg')  # Set backend first
-import matplotlib.pyplot as plt
-
-import yfinance as yf
 import traceback
 
+# The heavy modules (pandas, matplotlib, yfinance, tabulate, 
+# requests, smtplib) only get imported by lazyImport() when 
+# something actually needs them, so the daily run, bets and
+# --help start quickly.
+
 
 # Constants 
 MAXCACHEAGEHOURS = 2   #Age to expire cache files.
 ANALYSISPERIOD = 80     #Number of days to watch price after a check trigger
-TICKERGROUPSIZE = 2    #Number of tickers to fetch in one request
+
+# Stocks come from yahoo in one yf.download for each group of them
+# missing bars from the same day (YAHOONEWDAYS back for ones we've
+# no history for). If we asked yahoo before, it had already sent us
+# everything up to then, so we only go YAHOOREFETCHDAYS back from that
+# rather than all the way to a long-stale or delisted stock's last bar.
+# YAHOOTHREADS goes straight to yfinance: False, True, or a number of
+# threads. A failed download is tried YAHOORETRIES times, the wait
+# doubling from one second.
+YAHOOTHREADS = False
+YAHOORETRIES = 6
+YAHOONEWDAYS = 92
+YAHOOREFETCHDAYS = 5
+YAHOOFIELDS = ['Open','High','Low','Close','Volume']
+
+# The rows of our columnar price history, time is seconds 
+# since the epoch (midnight UTC for daily bars)
+PRICECOLUMNS = ['t','o','h','l','c','v']
+
+# New bars get appended to a per-ticker journal, this 
+# many bars in the journal and we compact it into the
+# main history file.
+JOURNALCOMPACTBARS = 64
+
+# Web responses are cached in caches/web, spread over 256 
+# sub-directories by the first two hex digits of the URL's sha1.
+# They're only reused for their PROVIDERTTL, so after a run that
+# added any we drop the expired ones, then the least recently
+# used until it all fits in WEBCACHEMAXBYTES. Bodies are zlib
+# compressed if WEBCACHECOMPRESS.
+WEBCACHEDIR = "caches/web"
+WEBCACHEMAXBYTES = 100*1024*1024
+WEBCACHECOMPRESS = True
+
+# When we last asked for each ticker's prices, for PROVIDERTTL
+FETCHEDFILE = "caches/fetched.json"
+
+# Bets are kept in an append-only journal, one JSON record per
+# line, with a small index pointing at the open ones by ticker.
+BETJOURNAL = "bets.jnl"
+BETINDEX = "bets.idx"
+
+# Before running the checks we refresh all the tickers at once,
+# each provider gets its own pool of this many fetch threads.
+# Yahoo stays at one as tickers share grouped downloads.
+PROVIDERCONCURRENCY = {
+  "yahoo"      : 1,
+  "binance"    : 4,
+  "bitfinex"   : 2,
+  "bitstamp"   : 2,
+  "bittrex"    : 2,
+  "huobi"      : 4,
+  "coinbase"   : 4,
+  "dexscreener": 2,
+}
+
+# How many symbols each provider lets us ask for in one request.
+# readTickers() splits each one's tickers into groups this big,
+# dexscreener only batching pairs on the same chain. World Trading
+# Data is the old stock API, so it groups the same tickers as yahoo.
+PROVIDERBATCHLIMITS = {
+  "yahoo"           : 500,
+  "worldtradingdata": 5,
+  "dexscreener"     : 30,
+}
+
+# The bar lengths we know, in seconds. Interval (--interval) is the
+# bar we fetch and store: daily, unless you want intraday crypto bars,
+# which go in history/<ticker>@<interval>.npy. The checks run on
+# CheckTimeframe (--timeframe) bars, built from the stored ones, and
+# "days ago" then means bars ago.
+INTERVALSECONDS = {"15m":900, "30m":1800, "1h":3600, "4h":14400, "1d":86400}
+
+# What each exchange calls those intervals. Only these can get us
+# intraday bars, the rest only do daily.
+PROVIDERINTERVALS = {
+  "binance" : {"15m":"15m",   "30m":"30m",   "1h":"1h",    "4h":"4h",    "1d":"1d"},
+  "bitfinex": {"15m":"15m",   "30m":"30m",   "1h":"1h",                  "1d":"1D"},
+  "huobi"   : {"15m":"15min", "30m":"30min", "1h":"60min", "4h":"4hour", "1d":"1day"},
+}
+
+# Most candles we can get in one request, when catching the crypto
+# exchanges up from our last bar. Longer gaps get paged through.
+BINANCEPAGE = 1000
+BITFINEXPAGE = 10000
+HUOBIMAXSIZE = 2000
+
+# Where each provider's API lives, which is also how we tell which
+# provider a URL belongs to for rate-limits and cache expiry. yahoo
+# is None as yfinance finds it itself. --base-url moves them all to
+# a --replay-server, which serves each at /<provider>.
+PROVIDERBASEURLS = {
+  "binance"         : "https://api.binance.com",
+  "bitfinex"        : "https://api-pub.bitfinex.com",
+  "bitstamp"        : "https://www.bitstamp.net",
+  "bittrex"         : "https://api.bittrex.com",
+  "huobi"           : "https://api.huobi.pro",
+  "coinbase"        : "https://api.coinbase.com",
+  "dexscreener"     : "https://api.dexscreener.com",
+  "worldtradingdata": "https://api.worldtradingdata.com",
+  "yahoo"           : None,
+}
+
+# --record saves every API response in FIXTURESDIR, one file per
+# URL under a directory per provider, for --replay-server to serve.
+# If it's got no fixture for the exact URL it'll make do with one
+# that only differs in these (from where / how many) parameters.
+# API keys are blanked out before we save anything.
+FIXTURESDIR = "fixtures"
+REPLAYLOOSEPARAMS = ["startTime","start","size","limit","api_token"]
+
+# Token-bucket rate limit for each provider: (requests per second, burst)
+# Set from what each API says it allows, with a bit of slack.
+PROVIDERRATELIMITS = {
+  "binance"    : (10.0, 20),
+  "bitfinex"   : (0.5, 5),
+  "bitstamp"   : (10.0, 10),
+  "bittrex"    : (1.0, 5),
+  "huobi"      : (10.0, 20),
+  "coinbase"   : (10.0, 10),
+  "dexscreener": (5.0, 10),
+}
+
+# How long, in seconds, before we ask a provider again for a bar 
+# it didn't have last time we asked, and how long its cached web
+# pages stay fresh. Providers not listed use MAXCACHEAGEHOURS.
+PROVIDERTTL = {
+  "yahoo"      : 2*60*60,
+  "binance"    : 60*60,
+  "bitfinex"   : 60*60,
+  "bitstamp"   : 60*60,
+  "bittrex"    : 60*60,
+  "huobi"      : 60*60,
+  "coinbase"   : 60*60,
+  "dexscreener": 30*60,
+}
+
+# Which trading calendar each stock exchange suffix follows.
+# Crypto trades every day, any other stock exchange just
+# on weekdays.
+EXCHANGECALENDARS = {
+  "L"  : "LSE",
+  "O"  : "NYSE",
+  "N"  : "NYSE",
+  "A"  : "NYSE",
+  "PK" : "NYSE",
+}
+
+# (Connect, Read) timeouts in seconds for the web requests
+HTTPTIMEOUT = (5, 30)
 
 # Options, mostly can be changed at the CLI or over-witten in my_secrets.py
 OUT_CSV_FILE = "export.csv"
@@ -137,6 +294,15 @@ TriggerPercent = 0.1
 #This is the Y, a series, it puts them in a table.
 TimeCheck_Periods = [1,5,10,15,20,25]
 
+# A parameter sweep (--sweep) ranks every combination of MA/EMA 
+# periods by the average gain, in the signal's direction, this
+# many bars after the signal. We show the best SweepTop of them
+# that have at least SweepMinCount signals.
+SweepRankPeriod = 20
+SweepTop = 20
+SweepMinCount = 5
+SweepSpec = None
+
 #We can ignore all tickers that don't contain a string. 
 TickerFilter = ""
 
@@ -152,6 +318,66 @@ Send_Email=False
 # How many days to back-test.
 BacktestDays = 0
 
+# Run the checks in this many processes, each taking a share
+# of the tickers. Mostly worth it for long back-tests.
+Workers = 1
+
+# Print how long starting up and each lazy import took.
+ProfileStartup = False
+
+# --daemon keeps going, with the prices, indicator states and pages
+# held in memory. Every DAEMONTICK seconds it fetches whatever could
+# have something new (each provider goes by its PROVIDERTTL), and
+# reruns the checks if anything came in or tickers.txt or the bets
+# changed. The alerts get sent at each of DaemonReportTimes (HH:MM,
+# local time), set by --report-at.
+Daemon = False
+DAEMONTICK = 60
+DaemonReportTimes = ["07:00"]
+
+# --profile times each phase of the run and each ticker, counts the
+# calls to the PROFILEDFUNCTIONS, and notes how high memory peaked,
+# then shows the PROFILETOP slowest of each at the end. ProfileDump
+# (--profile-dump FILE) also saves a cProfile of the main thread.
+Profile = False
+ProfileDump = None
+PROFILETOP = 10
+PROFILEDFUNCTIONS = ["getHtml","httpGet","checkForCache","loadPriceData",
+  "getPrices","getStockPrices","updatePriceData","getSeries","calculateEma",
+  "calculateMa","calculateRsi","calculateSequential","getStreamedIndicators",
+  "getActiveBacktestDays","runDayChecks","getBetOutcomes"]
+
+# Record API responses as fixtures (--record), or serve them on 
+# ReplayPort (--replay-server) taking ReplayLatency ms for each,
+# and failing ReplayErrorRate of requests with a 500 and 
+# ReplayRateLimitRate with a 429. Failures are drawn from a
+# random generator seeded with ReplaySeed, so runs repeat.
+RecordFixtures = False
+ReplayPort = None
+ReplayLatency = 0
+ReplayErrorRate = 0.0
+ReplayRateLimitRate = 0.0
+ReplaySeed = 1
+
+# Never fetch anything (--offline), just use the history we've got.
+Offline = False
+
+# The bars we store and the bars we check, see INTERVALSECONDS.
+# CheckTimeframe None means the same as Interval.
+Interval = "1d"
+CheckTimeframe = None
+
+# --bench times each phase of a run over made-up histories, written
+# into BENCHDIR's own history/ so the real one isn't touched. Each
+# of BenchSizes (tickers, years of daily bars) gets back-tested at
+# each of BenchDepths days, and the timings saved to BENCHFILE, in
+# BENCHDIR, as JSON to compare between versions.
+BENCHDIR = "bench"
+BENCHFILE = "bench.json"
+BenchSizes = None
+BenchDepths = [0,250]
+BenchSeed = 1
+
 #The email lists the checks which each ticker triggered,
 #You may limit it to show only those that passed multiple
 #triggers in the same day.
@@ -212,9 +438,21 @@ except IOError:
   exit()
 
 # Data store.
+lazyModules = {}
+startupMarks = [("core imports",time.time())]
 alerts = []
 htmlCache = {}
-datCache = {}
+htmlLocks = {}
+holidayCache = {}
+lastFetched = None
+webCacheWritten = 0
+priceCache = {}
+httpSessions = {}
+rateBuckets = {}
+httpLock = threading.Lock()
+indicatorStates = {}
+profileStats = {}
+profileLock = threading.Lock()
 uniqcodes = {}
 bullishness={}
 bullishness_tops={}
@@ -222,11 +460,15 @@ bullishness_bots={}
 bullreason={}
 bullreason_tops={}
 bullreason_bots={}
-resultLog={}
+resultLog=None     #See newResultLog()
 tickerParams = {}
 tickers = None
 unfilteredTickers = None
+tickerGroups = {}
 BetStore = []
+betsByTicker = {}
+betIndex = None
+betRecords = []
 PlaceBetArgs = None
 
 
@@ -247,7 +489,27 @@ options:
 -t --ticker XX       -> Filter tickers to check, partial match
 -p --percent X       -> Trigger winning percent for backtest report
 -H --fetch-history   -> Pull data from 'past' api not 'realtime'
+--migrate-history    -> Convert old history/*.json files to columns
 -B --bet price/target/stop/days/confidence/startDate -> bet 
+-w --workers N       -> Run the checks in N processes
+--profile-startup    -> Report how long starting up and imports took
+--profile            -> Report time, calls and memory by phase, ticker, function
+--profile-dump FILE  -> --profile, and save a cProfile of the run in FILE
+--cache-stats        -> Show what's in the web cache
+--cache-gc           -> Clear expired and excess pages from the web cache
+--sweep ema1=10:30:5,ma4=100:200:50 -> Rank MA/EMA period combinations
+--record             -> Save every API response in fixtures/
+--replay-server PORT -> Serve fixtures/ as if we were the APIs, with
+  --replay-latency MS, --replay-errors RATE, --replay-429 RATE
+--base-url URL       -> Fetch from a replay server instead of the APIs
+--offline            -> Don't fetch any prices, use the history we've got
+--daemon             -> Keep running, fetching and checking as prices come in
+--report-at 07:00,19:00 -> When the daemon sends the alerts
+--interval 1h        -> Fetch and keep 15m/30m/1h/4h bars, not daily
+  (Binance, Bitfinex and Huobi only)
+--timeframe 4h       -> Run the checks on bars built up from those
+--bench 100x5,1000x30 -> Time each phase over made-up tickers x years,
+  back-tested to each of --bench-depths 0,250 days
 
 Available Checks:
   """)
@@ -258,25 +520,372 @@ Available Checks:
 
 
 
+def lazyImport(name):
+  """
+  Import a module the first time it's asked for,
+  noting how long it took for --profile-startup
+  """
+  if(not name in lazyModules):
+    t = time.time()
+    lazyModules[name] = importlib.import_module(name)
+    startupMarks.append(("import "+name,t,time.time()))
+  return lazyModules[name]
+
+
+
+def tabulate(*args,**kwargs):
+  return lazyImport("tabulate").tabulate(*args,**kwargs)
+
+
+
+def getPyplot():
+  """
+  Matplotlib, set up to draw without a display
+  """
+  matplotlib = lazyImport("matplotlib")
+  matplotlib.use('Agg')  # Set backend first
+  return lazyImport("matplotlib.pyplot")
+
+
+
+def markStartup(label):
+  startupMarks.append((label,time.time()))
+
+
+
+def showStartupProfile():
+  """
+  Print the --profile-startup report: seconds since
+  the script started at each step of getting going,
+  and what each lazy import cost and when.
+  """
+  print("\nStartup profile (seconds since start):")
+  rows = []
+  for mark in startupMarks:
+    if(len(mark)==2):
+      rows.append([mark[0],"%0.3f"%(mark[1]-startupTime),""])
+    else:
+      rows.append([mark[0],"%0.3f"%(mark[1]-startupTime),"%0.3f"%(mark[2]-mark[1])])
+  rows.append(["exit","%0.3f"%(time.time()-startupTime),""])
+  print(tabulate(rows,["Step","At","Took"]))
+
+
+
+def peakMemory():
+  """
+  The most memory we've had at once so far, in bytes
+  """
+  try:
+    resource = lazyImport("resource")
+  except ImportError:
+    return 0
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return peak if (sys.platform=="darwin") else peak*1024
+
+
+
+def recordProfile(kind,name,seconds,grown=0):
+  """
+  Add a call to the --profile stats, which go by
+  (kind, name): [calls, seconds, peak memory at the
+  end of the call, how much the peak grew during].
+  """
+  peak = peakMemory()
+  with profileLock:
+    stat = profileStats.setdefault((kind,name),[0,0.0,0,0])
+    stat[0] += 1
+    stat[1] += seconds
+    stat[2] = max(stat[2],peak)
+    stat[3] += grown
+
+
+
+def profiled(name,fn,*args):
+  """
+  Call fn(*args), and if we're profiling note
+  the time and memory it took as a phase.
+  """
+  if(not Profile):
+    return fn(*args)
+  t, peak = time.time(), peakMemory()
+  try:
+    return fn(*args)
+  finally:
+    recordProfile("phase",name,time.time()-t,peakMemory()-peak)
+
+
+
+def profileFunctions(names):
+  """
+  Swap each of the named functions for one that counts
+  and times its calls. Only done under --profile, so
+  otherwise it costs nothing.
+  """
+  for name in names:
+    globals()[name] = profileWrapper(name,globals()[name])
+
+
+
+def profileWrapper(name,fn):
+  """
+  fn, but each call gets counted and timed
+  """
+  def wrapped(*args,**kwargs):
+    t = time.time()
+    try:
+      return fn(*args,**kwargs)
+    finally:
+      recordProfile("function",name,time.time()-t)
+  wrapped.__doc__ = fn.__doc__
+  return wrapped
+
+
+
+def startProfile():
+  """
+  Turn on --profile, and a cProfile if it's to be dumped
+  """
+  profileFunctions(PROFILEDFUNCTIONS)
+  atexit.register(showProfile)
+  if(ProfileDump!=None):
+    cProfile = lazyImport("cProfile")
+    profiler = cProfile.Profile()
+    profiler.enable()
+    atexit.register(dumpProfile,profiler)
+
+
+
+def dumpProfile(profiler):
+  """
+  Save the --profile-dump cProfile at exit
+  """
+  profiler.disable()
+  profiler.dump_stats(ProfileDump)
+  print("cProfile saved in "+ProfileDump)
+
+
+
+def showProfile():
+  """
+  Print the --profile report: the phases in the order
+  they ran, then the slowest tickers and functions.
+  Only phases and checks measure how much the peak
+  memory grew, so only they get that column.
+  """
+  print("\nProfile, phases:")
+  print(tabulate(profileRows("phase",None,True),["Phase","Calls","Seconds","Peak MB","Grew MB"]))
+  for kind,title,grown in (("check","Slowest tickers to check",True),("fetch","Slowest tickers to fetch",False),("function","Slowest functions",False)):
+    found = profileRows(kind,PROFILETOP,grown)
+    if(len(found)>0):
+      print("\n%s:" % title)
+      print(tabulate(found,["Name","Calls","Seconds","Peak MB","Grew MB"][0:len(found[0])]))
+
+
+
+def profileRows(kind,top,grown):
+  """
+  The table rows of one kind of --profile stats, the
+  top slowest of them if top isn't None, with how
+  much memory grew if grown.
+  """
+  stats = [(k[1],v) for k,v in profileStats.items() if k[0]==kind]
+  if(top!=None):
+    stats = sorted(stats,key=profileSeconds,reverse=True)[0:top]
+  rows = []
+  for name,v in stats:
+    row = [name,v[0],"%0.3f"%v[1],"%0.1f"%(v[2]/1048576.0)]
+    if(grown):
+      row.append("%+0.1f"%(v[3]/1048576.0))
+    rows.append(row)
+  return rows
+
+
+
+def profileSeconds(stat):
+  """
+  Sort key for (name, stats) by total seconds
+  """
+  return stat[1][1]
+
+
+
 def readBets():
   """
-  Load in the JSON file representing bets we have recorded
+  Load in the bets we have recorded. A normal run only
+  needs the open ones, which the index points straight
+  at, but back-testing wants the lot. An old bets.json
+  gets moved into the journal the first time.
   """
-  global BetStore
-  fileName = "bets.json"
-  BetStore = checkForCache(fileName,expire=-1);
-  if(BetStore==None):
-    print("Creating new BetStore")
-    BetStore = []
+  global BetStore, betIndex, betRecords
+  betRecords = []
+  if((not os.path.isfile(BETJOURNAL)) and (os.path.isfile("bets.json"))):
+    migrateBets()
+  betIndex = checkForCache(BETINDEX,expire=-1)
+  if((betIndex==None) or (betIndex['sz']!=betJournalSize())):
+    BetStore, betIndex = readBetJournal()
+    if(os.path.isfile(BETJOURNAL)):
+      writeFile(BETINDEX,json.dumps(betIndex))
+  elif(BacktestDays>0):
+    BetStore = readBetJournal()[0]
+  else:
+    BetStore = readOpenBets(betIndex)
+  indexBets()
+
 
 
 def saveBets():
   """
-  Save out the JSON file representing bets we have recorded
+  Append any new bets and status changes to the journal
+  and bring the index up to date. Nothing changed,
+  nothing gets written.
   """
-  fileName = "bets.json"
-  out=json.dumps(BetStore, indent=2, sort_keys = True )
-  writeFile(fileName, out)
+  global betRecords
+  if(len(betRecords)==0):
+    return
+  appendBetJournal(betRecords)
+  betRecords = []
+  writeFile(BETINDEX,json.dumps(betIndex))
+
+
+
+def betJournalSize():
+  if(not os.path.isfile(BETJOURNAL)):
+    return 0
+  return os.path.getsize(BETJOURNAL)
+
+
+
+def readBetJournal():
+  """
+  Read every bet in the journal with its latest status,
+  building the index of open bets as we go. Placing a
+  bet writes the bet, status changes write its id, rc
+  (W/L/E for won, lost, expired), rp and rd (price and
+  date). A half-written last line (CTRL-C!) is ignored.
+  """
+  bets = []
+  byId = {}
+  offsets = {}
+  index = {'sz': 0, 'n': 0, 'open': {}, 'st': {}}
+  if(os.path.isfile(BETJOURNAL)):
+    ObjRead = open(BETJOURNAL, "rb")
+    for line in ObjRead:
+      if(not line.endswith(b"\n")):
+        break
+      rec = json.loads(line)
+      if('tk' in rec):
+        bets.append(rec)
+        byId[rec['id']] = rec
+        offsets[rec['id']] = index['sz']
+        index['n'] = max(index['n'],rec['id']+1)
+      elif(rec['id'] in byId):
+        byId[rec['id']].update(rec)
+      index['sz'] += len(line)
+    ObjRead.close()
+
+  for b in bets:
+    index['st'][b['rc']] = index['st'].get(b['rc'],0)+1
+    if(b['rc']=='P'):
+      index['open'].setdefault(b['tk'],[]).append([b['id'],offsets[b['id']]])
+  return bets, index
+
+
+
+def readOpenBets(index):
+  """
+  Read just the open bets, seeking straight to 
+  each one's record using the index.
+  """
+  bets = []
+  offsets = sorted([o[1] for tk in index['open'] for o in index['open'][tk]])
+  if(len(offsets)>0):
+    ObjRead = open(BETJOURNAL, "rb")
+    for offset in offsets:
+      ObjRead.seek(offset)
+      bets.append(json.loads(ObjRead.readline()))
+    ObjRead.close()
+  return bets
+
+
+
+def appendBetJournal(records):
+  """
+  Append records to the bet journal, updating the
+  index with where each new bet is and what's open.
+  Anything past the end of the index is a half-written
+  record from an interrupted run, so it gets chopped.
+  A status change for a bet that's not open any more
+  has already been written, so it's skipped.
+  """
+  ObjWrite = open(BETJOURNAL, "ab")
+  if(ObjWrite.tell()!=betIndex['sz']):
+    ObjWrite.truncate(betIndex['sz'])
+  for rec in records:
+    line = (json.dumps(rec, sort_keys = True)+"\n").encode()
+    if('tk' in rec):
+      betIndex['open'].setdefault(rec['tk'],[]).append([rec['id'],betIndex['sz']])
+      betIndex['st']['P'] = betIndex['st'].get('P',0)+1
+    else:
+      wasOpen = False
+      for tk in list(betIndex['open']):
+        stillOpen = [o for o in betIndex['open'][tk] if o[0]!=rec['id']]
+        if(len(stillOpen)<len(betIndex['open'][tk])):
+          wasOpen = True
+        betIndex['open'][tk] = stillOpen
+        if(len(betIndex['open'][tk])==0):
+          del betIndex['open'][tk]
+      if(not wasOpen):
+        continue
+      betIndex['st']['P'] -= 1
+      betIndex['st'][rec['rc']] = betIndex['st'].get(rec['rc'],0)+1
+    ObjWrite.write(line)
+    betIndex['sz'] += len(line)
+  ObjWrite.flush()
+  os.fsync(ObjWrite.fileno())
+  ObjWrite.close()
+
+
+
+def migrateBets():
+  """
+  Move the bets from the old bets.json into the
+  journal. The JSON is kept as bets.json.bak
+  """
+  old = checkForCache("bets.json",expire=-1)
+  if(old==None):
+    old = []
+  out = ""
+  for i in range(0,len(old)):
+    old[i]['id'] = i
+    out += json.dumps(old[i], sort_keys = True)+"\n"
+  writeFile(BETJOURNAL, out)
+  os.rename("bets.json","bets.json.bak")
+  print("Migrated %d bets to %s" % (len(old),BETJOURNAL))
+
+
+
+def resolveBet(b,status,price,dateKey):
+  """
+  Record that an open bet is over: won, lost or expired
+  """
+  if(b['rc']!='P'):
+    return
+  b['rc'] = status
+  b['rp'] = price
+  b['rd'] = dateKey
+  betRecords.append({'id': b['id'], 'rc': status, 'rp': price, 'rd': dateKey})
+
+
+
+def indexBets():
+  """
+  Index the bets by ticker, keeping them
+  in the order they are in the BetStore
+  """
+  global betsByTicker
+  betsByTicker = {}
+  for b in BetStore:
+    betsByTicker.setdefault(b['tk'],[]).append(b)
 
 
 
@@ -284,7 +893,7 @@ def readTickers():
   """
   Read the list of tickers
   """
-  global tickers, tickerParams, TickerFilter, LogLevel, unfilteredTickers, TickersName
+  global tickers, tickerParams, TickerFilter, LogLevel, unfilteredTickers, TickersName, tickerGroups
   if(tickers==None):
     tickers = []
     unfilteredTickers = []
@@ -324,156 +933,925 @@ def readTickers():
           tickers.append(t)
         if(len(params)>1):
           tickerParams[t] = params[1:]
+    tickerGroups = groupTickers(unfilteredTickers)
+
+  return tickers
+  
+  
+
+
+def groupTickers(allTickers):
+  """
+  Some services limit how many requests we
+  can do, and yet also let us ask for multiple
+  stocks in a single request. So once, when we
+  read the tickers, we split them into groups of
+  each provider's PROVIDERBATCHLIMITS. Gives
+  {provider: {ticker: its whole group}}.
+  """
+  groups = {}
+  for provider in PROVIDERBATCHLIMITS:
+    size = PROVIDERBATCHLIMITS[provider]
+    byKey = {}
+    for t in dict.fromkeys(allTickers):
+      key = batchKey(t,provider)
+      if(key!=None):
+        byKey.setdefault(key,[]).append(t)
+    groups[provider] = {}
+    for key in byKey:
+      for i in range(0,len(byKey[key]),size):
+        group = byKey[key][i:i+size]
+        for t in group:
+          groups[provider][t] = group
+  return groups
+
+
+
+def batchKey(ticker,provider):
+  """
+  Tickers with the same key can share a request
+  to the provider, None means it can't have this
+  ticker at all.
+  """
+  if(provider=="worldtradingdata"):
+    provider = "yahoo"
+  if(getProvider(ticker)!=provider):
+    return None
+  if(provider=="dexscreener"):
+    return ticker.split("/")[0]
+  return provider
+
+
+
+def getTickerGroup(ticker,provider):
+  """
+  The tickers we fetch along with this one from
+  provider, worked out by groupTickers(). Just
+  the ticker itself if it's not in a group.
+  """
+  return tickerGroups.get(provider,{}).get(ticker,[ticker])
+
+
+
+def writeFile(filename,dat):
+  """
+  We have a function to write a file coz all our data 
+  is in files, and on Unix at least we want to create
+  new files then rename them to the old file in case
+  something bad happens during the write
+  (like me pressing CTRL-C, which apparently is often)
+  """
+  mode = "wb" if isinstance(dat,bytes) else "w"
+  if(DoSafeFileWrite):
+    ObjWrite = open(filename+".new", mode)
+    ObjWrite.write(dat)
+    ObjWrite.close()
+    os.rename(filename+".new", filename)
+  else:
+    ObjWrite = open(filename, mode)
+    ObjWrite.write(dat)
+    ObjWrite.close()
+
+
+
+def writeArrayFile(filename,arr):
+  """
+  Same as writeFile, but for our binary
+  numpy arrays of prices.
+  """
+  if(DoSafeFileWrite):
+    ObjWrite = open(filename+".new", "wb")
+    np.save(ObjWrite, arr)
+    ObjWrite.close()
+    os.rename(filename+".new", filename)
+  else:
+    arr = np.array(arr)   #We may be about to overwrite our own memmap.
+    ObjWrite = open(filename, "wb")
+    np.save(ObjWrite, arr)
+    ObjWrite.close()
+
+
+
+def getHtml(url):
+  """
+  Get a page from the web. We keep the pages we've
+  got in memory too, for as long as the web cache
+  would, which matters when we're a --daemon.
+  Fetcher threads that want the same page (the
+  dexscreener pairs on a chain) wait for the first
+  one to get it, rather than all fetch and write it.
+  The lock goes once nobody's using it, or a daemon
+  would keep one for every URL it ever asked for.
+  """
+  with httpLock:
+    lock = htmlLocks.setdefault(url,[threading.Lock(),0])
+    lock[1] += 1
+  try:
+    with lock[0]:
+      return getHtmlUnlocked(url)
+  finally:
+    with httpLock:
+      lock[1] -= 1
+      if(lock[1]==0):
+        del htmlLocks[url]
+
+
+
+def getHtmlUnlocked(url):
+  """
+  getHtml() once we've got the page to ourselves.
+  """
+  global htmlCache;
+  if((url in htmlCache) and (time.time()-htmlCache[url][0] < webCacheTtl(url))):
+    return htmlCache[url][1]
+
+  page = readWebCache(url)
+  status = 200
+
+  if(page==None):
+    page=""
+    resource = httpGet(url)
+    page += resource.content.decode('utf-8', errors='ignore')
+    status = resource.status_code
+    resource.close()
+
+    #Save it for cachiness, but not if it's an error
+    if(status==200):
+      writeWebCache(url,page)
+
+  if(RecordFixtures):
+    provider = urlProvider(url)
+    recordFixture(provider,url[len(PROVIDERBASEURLS.get(provider) or ""):],page,status)
+  if(status==200):
+    htmlCache[url] = (time.time(),page)
+  return page
+
+
+
+def webCacheFileName(url):
+  h = hashlib.sha1(url.encode('utf-8')).hexdigest()
+  return WEBCACHEDIR+"/"+h[0:2]+"/"+h
+
+
+
+def webCacheTtl(url):
+  return providerTtl(urlProvider(url))
+
+
+
+def readWebCache(url):
+  """
+  Our cached copy of a page, if we have one that's
+  not expired. Reading it touches its access time,
+  which is what the LRU eviction goes by.
+  """
+  fn = webCacheFileName(url)
+  ttl = webCacheTtl(url)
+  for name in (fn+".z", fn):
+    try:
+      st = os.stat(name)
+    except OSError:
+      continue
+    if(st.st_mtime < time.time()-ttl):
+      return None
+    try:
+      ObjRead = open(name, "rb")
+      dat = ObjRead.read()
+      ObjRead.close()
+      if(name.endswith(".z")):
+        dat = zlib.decompress(dat)
+      os.utime(name,(time.time(),st.st_mtime))
+    except Exception as e:
+      print("Error Doing Web Cache "+name+":"+str(e))
+      return None
+    return dat.decode('utf-8', errors='ignore')
+  return None
+
+
+
+def writeWebCache(url,page):
+  """
+  Save a page in the web cache
+  """
+  global webCacheWritten
+  fn = webCacheFileName(url)
+  os.makedirs(os.path.dirname(fn),exist_ok=True)
+  if(WEBCACHECOMPRESS):
+    writeFile(fn+".z",zlib.compress(page.encode('utf-8')))
+    old = fn
+  else:
+    writeFile(fn,page)
+    old = fn+".z"
+  if(os.path.isfile(old)):
+    os.remove(old)
+  webCacheWritten += 1
+
+
+
+def scanWebCache():
+  """
+  Every entry in the web cache as (access time, size,
+  filename, modified time), and the names of any
+  old-style caches/web-* files left lying about.
+  """
+  entries = []
+  legacy = []
+  if(os.path.isdir(WEBCACHEDIR)):
+    for shard in os.scandir(WEBCACHEDIR):
+      if(shard.is_dir()):
+        for e in os.scandir(shard.path):
+          if(e.is_file() and not e.name.endswith(".new")):
+            st = e.stat()
+            entries.append((st.st_atime, st.st_size, e.path, st.st_mtime))
+  if(os.path.isdir("caches")):
+    for e in os.scandir("caches"):
+      if(e.is_file() and e.name.startswith("web-")):
+        legacy.append(e.path)
+  return entries, legacy
+
+
+
+def webCacheGc():
+  """
+  Drop expired pages from the web cache, then the
+  least recently used until it fits WEBCACHEMAXBYTES.
+  Old-style caches/web-* files all go. Returns the
+  number of files removed and bytes freed.
+  """
+  entries, legacy = scanWebCache()
+  expire = time.time()-max([MAXCACHEAGEHOURS*60*60]+list(PROVIDERTTL.values()))
+  doomed = [e for e in entries if e[3]<expire]
+  keep = sorted([e for e in entries if e[3]>=expire],reverse=True)
+  total = 0
+  for e in keep:
+    total += e[1]
+    if(total>WEBCACHEMAXBYTES):
+      doomed.append(e)
+  doomed = [(e[2],e[1]) for e in doomed] + [(fn,os.path.getsize(fn)) for fn in legacy]
+
+  removed = 0
+  freed = 0
+  for fn,size in doomed:
+    try:
+      os.remove(fn)
+      removed += 1
+      freed += size
+    except OSError:
+      None
+  return removed, freed
+
+
+
+def showWebCacheStats():
+  """
+  Print what's in the web cache
+  """
+  entries, legacy = scanWebCache()
+  now = time.time()
+  fresh = [e for e in entries if e[3]>=now-MAXCACHEAGEHOURS*60*60]
+  total = sum([e[1] for e in entries])
+  print("Web cache in %s:" % (WEBCACHEDIR))
+  print("  %d pages, %0.1f MB of %0.1f MB allowed%s" % (len(entries),total/1048576.0,WEBCACHEMAXBYTES/1048576.0,", compressed" if WEBCACHECOMPRESS else ""))
+  print("  %d still fresh (under %d hours old)" % (len(fresh),MAXCACHEAGEHOURS))
+  if(len(entries)>0):
+    print("  Oldest written %0.1f hours ago, least recently used %0.1f hours ago" % ((now-min([e[3] for e in entries]))/3600,(now-min([e[0] for e in entries]))/3600))
+  if(len(legacy)>0):
+    print("  %d old-style caches/web-* files, --cache-gc will remove them" % (len(legacy)))
+
+
+
+class FetchError(Exception):
+  """
+  We couldn't get a page, even after trying again
+  """
+
+
+
+def httpGet(url):
+  """
+  Fetch a URL over the keep-alive session for its
+  host, waiting our turn on the provider's rate
+  limit. If they tell us to back off anyway (429,
+  or 418 from Binance) we wait as long as they ask
+  and try again, same for server errors, timeouts
+  and dropped connections. If it's still failing
+  after the last go we raise a FetchError.
+  """
+  requests = lazyImport("requests")
+  host = urlparse(url).hostname
+  provider = urlProvider(url)
+  session = getHttpSession(host)
+  for attempt in range(0,4):
+    waitForRateToken(provider)
+    wait = 2.0**attempt
+    try:
+      resource = session.get(url,timeout=HTTPTIMEOUT)
+    except requests.exceptions.RequestException as e:
+      problem = e.__class__.__name__
+    else:
+      if(not resource.status_code in (418,429,500,502,503,504)):
+        return resource
+      problem = "Got %d" % resource.status_code
+      retryAfter = resource.headers.get("Retry-After","")
+      if(retryAfter.isnumeric()):
+        wait = float(retryAfter)
+      resource.close()
+    if(attempt==3):
+      break
+    print("%s from %s, waiting %0.1fs" % (problem,provider,wait))
+    time.sleep(wait)
+  raise FetchError(problem+" from "+url)
+
+
+
+def urlProvider(url):
+  """
+  Which provider's API is this URL for?
+  The host itself if we don't know.
+  """
+  for provider in PROVIDERBASEURLS:
+    base = PROVIDERBASEURLS[provider]
+    if((base!=None) and (url.startswith(base+"/"))):
+      return provider
+  return urlparse(url).hostname
+
+
+
+def providerUrl(provider,path):
+  return PROVIDERBASEURLS[provider]+path
+
+
+
+def setBaseUrl(base):
+  """
+  Send every provider's requests to base, as
+  base/<provider>, for a --replay-server.
+  """
+  for provider in PROVIDERBASEURLS:
+    PROVIDERBASEURLS[provider] = base.rstrip("/")+"/"+provider
+
+
+
+def fixtureFileName(provider,path):
+  return FIXTURESDIR+"/"+provider+"/"+hashlib.sha1(path.encode('utf-8')).hexdigest()+".json"
+
+
+
+def recordFixture(provider,path,page,status=200):
+  """
+  Save an API response for --replay-server, keyed
+  by its provider and the path after the base URL.
+  """
+  path = path.replace("api_token="+API_KEY,"api_token=")
+  fn = fixtureFileName(provider,path)
+  os.makedirs(os.path.dirname(fn),exist_ok=True)
+  writeFile(fn,json.dumps({'path':path,'status':status,'body':page}))
+
+
+
+def loadFixtures():
+  """
+  All the recorded fixtures, as {provider: {path: fixture}}
+  """
+  fixtures = {}
+  if(not os.path.isdir(FIXTURESDIR)):
+    return fixtures
+  for provider in os.listdir(FIXTURESDIR):
+    fixtures[provider] = {}
+    for fn in os.listdir(FIXTURESDIR+"/"+provider):
+      with open(FIXTURESDIR+"/"+provider+"/"+fn) as f:
+        fixture = json.load(f)
+      fixtures[provider][fixture['path']] = fixture
+  return fixtures
+
+
+
+def findFixture(fixtures,provider,path):
+  """
+  The fixture recorded for this exact path, or failing
+  that one that only differs in REPLAYLOOSEPARAMS, so a 
+  replay still works after our last bar has moved on.
+  """
+  recorded = fixtures.get(provider,{})
+  if(path in recorded):
+    return recorded[path]
+  want = strictFixturePath(path)
+  for p in sorted(recorded):
+    if(strictFixturePath(p)==want):
+      return recorded[p]
+  return None
+
+
+
+def strictFixturePath(path):
+  """
+  A fixture path without its REPLAYLOOSEPARAMS,
+  as (path, sorted query params), for matching.
+  """
+  bits = urlparse(path)
+  return (bits.path,sorted([kv for kv in parse_qsl(bits.query) if not kv[0] in REPLAYLOOSEPARAMS]))
+
+
+
+def runReplayServer(port):
+  """
+  Stand in for all the providers, serving the recorded
+  fixtures at /<provider>/<recorded path>. Each request
+  takes ReplayLatency ms, give or take half, and some
+  get a 429 or 500 instead, per ReplayRateLimitRate and
+  ReplayErrorRate. Runs until CTRL-C.
+  """
+  server = lazyImport("http.server")
+  fixtures = loadFixtures()
+  rng = random.Random(ReplaySeed)
+  rngLock = threading.Lock()
+
+  class ReplayHandler(server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"    #Keep-alive, like the real thing
+
+    def do_GET(self):
+      with rngLock:
+        roll = rng.random()
+        delay = ReplayLatency/1000.0*rng.uniform(0.5,1.5)
+      time.sleep(delay)
+      bits = self.path.split("/",2)
+      headers = {}
+      if(roll<ReplayRateLimitRate):
+        status, body = 429, "Too many requests"
+        headers["Retry-After"] = "1"
+      elif(roll<ReplayRateLimitRate+ReplayErrorRate):
+        status, body = 500, "Replayed server error"
+      else:
+        fixture = findFixture(fixtures,bits[1],"/"+(bits[2] if len(bits)>2 else ""))
+        if(fixture==None):
+          status, body = 404, "No fixture for "+self.path
+        else:
+          status, body = fixture['status'], fixture['body']
+      body = body.encode('utf-8')
+      self.send_response(status)
+      for k in headers:
+        self.send_header(k,headers[k])
+      self.send_header("Content-Length",str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self,format,*args):
+      if(LogLevel>=2):
+        server.BaseHTTPRequestHandler.log_message(self,format,*args)
+
+  httpd = server.ThreadingHTTPServer(("127.0.0.1",port),ReplayHandler)
+  print("Replaying %d fixtures on http://127.0.0.1:%d" % (sum([len(f) for f in fixtures.values()]),port))
+  try:
+    httpd.serve_forever()
+  except KeyboardInterrupt:
+    pass
+
+
+
+def getHttpSession(host):
+  """
+  One requests Session per host, so we keep a
+  pool of connections open and don't pay for a
+  new TCP and TLS handshake on every request.
+  """
+  global httpSessions
+  with httpLock:
+    if(not host in httpSessions):
+      requests = lazyImport("requests")
+      session = requests.Session()
+      poolSize = max(PROVIDERCONCURRENCY.values())
+      adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=poolSize)
+      session.mount("https://", adapter)
+      session.mount("http://", adapter)
+      httpSessions[host] = session
+    return httpSessions[host]
+
+
+
+def waitForRateToken(provider):
+  """
+  Token-bucket rate limiting. Each provider's bucket
+  refills at the rate in PROVIDERRATELIMITS up to its
+  burst size, and each request takes a token, waiting
+  for one to drip in if the bucket's empty.
+  """
+  global rateBuckets
+  if(not provider in PROVIDERRATELIMITS):
+    return
+  rate, burst = PROVIDERRATELIMITS[provider]
+  while(True):
+    with httpLock:
+      now = time.time()
+      if(not provider in rateBuckets):
+        rateBuckets[provider] = {'tk': burst, 'ts': now}
+      bucket = rateBuckets[provider]
+      bucket['tk'] = min(burst, bucket['tk'] + (now-bucket['ts'])*rate)
+      bucket['ts'] = now
+      if(bucket['tk']>=1):
+        bucket['tk'] -= 1
+        return
+      wait = (1-bucket['tk'])/rate
+    time.sleep(wait)
+
+
+
+def checkForCache(cacheFileName,expire=0):
+  """
+  Check if we have a data-cache and
+  return it if we do
+  """
+  if(expire==0):
+    expire = MAXCACHEAGEHOURS*60*60;
+  now = time.time()
+  yesterday = now-expire;
+  if((os.path.isfile(cacheFileName)) and ((expire<0) or (os.path.getmtime(cacheFileName)>yesterday))):
+    try:
+      data = json.load(open(cacheFileName))
+    except Exception as e:
+      print("Error Doing "+cacheFileName+":"+str(e))
+      exit();
+    return data
+  else:
+    return None
+
+
+
+def getPrices(ticker,prices=None):
+  """
+  Get the entire-history price-data for
+  a given ticker in my format, and call
+  on the API only if we seem to be out of
+  date. We return the columnar array, one
+  row per PRICECOLUMNS entry, one column 
+  per bar, oldest first. Pass in prices if
+  they're already loaded.
+  """
+  ticker = str(ticker)
+  if(prices is None):
+    prices = loadPriceData(ticker)
+
+  if(needsRefresh(ticker,prices)):
+    if(getProvider(ticker)=="yahoo"):
+      return getStockPrices({ticker:prices})[ticker]
+    fetchStart = time.time()
+    since = None
+    if(prices.shape[1]>0):
+      since = prices[0][-1]
+    try:
+      newBars = appendLatestPriceData(ticker,{},since)
+    except FetchError as e:
+      print("Can't fetch "+ticker+", using the prices we have: "+str(e))
+      return prices
+    if(lastFetched!=None):
+      lastFetched[ticker+intervalSuffix()] = fetchStart
+    if(newBars.shape[1]>0):
+      prices = updatePriceData(ticker,prices,newBars)
+    if(Profile):
+      recordProfile("fetch",ticker,time.time()-fetchStart)
+
+  return prices
+
+
+
+def needsRefresh(ticker,prices):
+  """
+  Could the provider have a bar we haven't got? Not if
+  we've got today's, nor if the exchange hasn't traded
+  since our last bar (weekends, holidays). Nor if we
+  asked it less than its PROVIDERTTL ago, whatever
+  it sent us then.
+  Intraday bars are new as soon as the next starts,
+  but only some exchanges can send us them at all.
+  The daemon also keeps the bar that's still forming
+  up to date, so that goes by the PROVIDERTTL too.
+  """
+  if(Offline):
+    return False
+  if((Interval!="1d") and (not Interval in PROVIDERINTERVALS.get(getProvider(ticker),{}))):
+    return False
+  if((prices.shape[1]==0) or (FetchHistory==True)):
+    return True
+  if(Interval!="1d"):
+    #Crypto never stops, so there's a new bar as soon as one's started
+    forming = (time.time() < prices[0,-1]+INTERVALSECONDS[Interval])
+  else:
+    today = date.today()
+    lastBar = date(1970,1,1)+timedelta(days=int(prices[0,-1]//86400))
+    forming = (lastBar>=today)
+    if(not forming):
+      calendar = getCalendar(ticker)
+      day = lastBar+timedelta(days=1)
+      while(not isTradingDay(calendar,day)):
+        if(day>=today):
+          return False
+        day += timedelta(days=1)
+  if(forming and (not Daemon)):
+    return False
+  if(lastFetched!=None):
+    if(time.time()-lastFetched.get(ticker+intervalSuffix(),0) < providerTtl(getProvider(ticker))):
+      return False
+  return True
+
+
+
+def providerTtl(provider):
+  """
+  How long what a provider sent us stays good:
+  its PROVIDERTTL, but never longer than a bar.
+  """
+  return min(PROVIDERTTL.get(provider,MAXCACHEAGEHOURS*60*60),INTERVALSECONDS[Interval])
+
+
+
+def getCalendar(ticker):
+  """
+  Which trading calendar does this ticker follow?
+  """
+  if(getProvider(ticker)!="yahoo"):
+    return "crypto"
+  return EXCHANGECALENDARS.get(ticker.split(".")[-1],"weekdays")
+
+
+
+def isTradingDay(calendar,day):
+  """
+  Is the exchange open on this date?
+  """
+  if(calendar=="crypto"):
+    return True
+  if(day.weekday()>=5):
+    return False
+  return not day in getHolidays(calendar,day.year)
+
+
+
+def getHolidays(calendar,year):
+  """
+  The weekday holidays of an exchange in a year.
+  Only the regular ones, the odd one-off (royal
+  funerals and the like) will just get fetched.
+  """
+  key = (calendar,year)
+  if(key in holidayCache):
+    return holidayCache[key]
+
+  days = set()
+  easter = easterSunday(year)
+  if(calendar=="NYSE"):
+    if(date(year,1,1).weekday()!=5):     #Saturday New Year isn't moved back a year
+      days.add(nyseObserved(date(year,1,1)))
+    days.add(nthWeekday(year,1,0,3))     #Martin Luther King
+    days.add(nthWeekday(year,2,0,3))     #Washington's Birthday
+    days.add(easter-timedelta(days=2))   #Good Friday
+    days.add(nthWeekday(year,5,0,-1))    #Memorial Day
+    if(year>=2022):
+      days.add(nyseObserved(date(year,6,19)))  #Juneteenth
+    days.add(nyseObserved(date(year,7,4)))   #Independence Day
+    days.add(nthWeekday(year,9,0,1))     #Labor Day
+    days.add(nthWeekday(year,11,3,4))    #Thanksgiving
+    days.add(nyseObserved(date(year,12,25))) #Christmas
+
+  elif(calendar=="LSE"):
+    newYear = date(year,1,1)
+    while(newYear.weekday()>=5):
+      newYear += timedelta(days=1)
+    days.add(newYear)
+    days.add(easter-timedelta(days=2))   #Good Friday
+    days.add(easter+timedelta(days=1))   #Easter Monday
+    days.add(nthWeekday(year,5,0,1))     #Early May
+    days.add(nthWeekday(year,5,0,-1))    #Spring
+    days.add(nthWeekday(year,8,0,-1))    #Summer
+    #Christmas and Boxing Day, with substitutes after a weekend
+    christmas = date(year,12,25)
+    if(christmas.weekday()==5):
+      days.update([date(year,12,27),date(year,12,28)])
+    elif(christmas.weekday()==6):
+      days.update([date(year,12,26),date(year,12,27)])
+    elif(christmas.weekday()==4):
+      days.update([date(year,12,25),date(year,12,28)])
+    else:
+      days.update([date(year,12,25),date(year,12,26)])
+
+  holidayCache[key] = days
+  return days
+
+
+
+def easterSunday(year):
+  """
+  Easter Sunday, by the anonymous Gregorian algorithm
+  """
+  a = year % 19
+  b = year // 100
+  c = year % 100
+  h = (19*a + b - b//4 - (b - (b+8)//25 + 1)//3 + 15) % 30
+  l = (32 + 2*(b%4) + 2*(c//4) - h - c%4) % 7
+  m = (a + 11*h + 22*l) // 451
+  return date(year, (h+l-7*m+114)//31, ((h+l-7*m+114)%31)+1)
+
+
+
+def nthWeekday(year,month,weekday,n):
+  """
+  The nth weekday (Monday=0) of a month,
+  or the last one when n is -1
+  """
+  if(n>0):
+    day = date(year,month,1)
+    return day+timedelta(days=(weekday-day.weekday())%7 + 7*(n-1))
+  day = date(year+month//12,month%12+1,1)-timedelta(days=1)
+  return day-timedelta(days=(day.weekday()-weekday)%7)
+
+
+
+def nyseObserved(day):
+  """
+  The NYSE moves a holiday on a Saturday to the
+  Friday before, and one on a Sunday to the Monday
+  """
+  if(day.weekday()==5):
+    return day-timedelta(days=1)
+  if(day.weekday()==6):
+    return day+timedelta(days=1)
+  return day
+
+
+
+def historyFileName(ticker,ext=".npy"):
+  """
+  Where we keep the price history for a ticker
+  """
+  return "history/"+(ticker.replace("/","__"))+intervalSuffix()+ext
+
+
+
+def intervalSuffix():
+  """
+  Daily histories are just named after the ticker,
+  intraday ones get @ and the interval on the end.
+  """
+  return "" if (Interval=="1d") else "@"+Interval
 
-  return tickers
-  
-  
 
 
-def getTickerGroup(ticker,groupSize):
+def dateToTimestamp(dtkey):
   """
-  Some services limit how many requests we
-  can do, and yet also let us ask for multiple
-  stocks in a single request, so we want to 
-  group them into groups of groupSize and
-  return the whole group
-  """
-  global unfilteredTickers
-  ret=[]
-  isGrouped = ["O", "N", "L"]
-  tickersTmp = []
-  for t in unfilteredTickers:
-    for g in isGrouped:
-      if(t.endswith(g)):
-        tickersTmp.append(t)
-  
-  for n in range(0,len(tickersTmp)):
-    testticker = tickersTmp[n]
-    if(testticker==ticker):
-      groupNumber = n/groupSize
-      index = int(groupNumber*groupSize)
-      for i in range(index,min(int(len(tickersTmp)),index+int(groupSize))):
-        t = tickersTmp[i]
-        t = t.replace("..",".");
-        if((t.endswith(".O")) or (t.endswith(".N"))):
-          t = t[0:-2]
-        ret.append(t)
-      return ret
-  return None 
+  Turn an ISO date key into the seconds-since-epoch
+  we keep in the time column
+  """
+  return float(np.datetime64(dtkey[0:10],'D').astype('datetime64[s]').astype(np.int64))
 
 
 
-def writeFile(filename,dat):
+def loadPriceData(ticker):
   """
-  We have a function to write a file coz all our data 
-  is in files, and on Unix at least we want to create
-  new files then rename them to the old file in case
-  something bad happens during the write
-  (like me pressing CTRL-C, which apparently is often)
+  Load the price history for a ticker. The columnar
+  file is memory-mapped, so only the bars we actually
+  look at get read from disk. Any bars in the journal
+  since the last compaction are laid over the top.
+  If there's only an old JSON history we convert that,
+  and it'll get saved as columns next time we save.
   """
-  if(DoSafeFileWrite):
-    ObjWrite = open(filename+".new", "w")
-    ObjWrite.write(dat)
-    ObjWrite.close()
-    os.rename(filename+".new", filename)
+  fn = historyFileName(ticker)
+  if(os.path.isfile(fn)):
+    try:
+      prices = np.load(fn,mmap_mode='r')
+    except Exception as e:
+      print("Error Doing "+fn+":"+str(e))
+      exit();
   else:
-    ObjWrite = open(filename, "w")
-    ObjWrite.write(dat)
-    ObjWrite.close()
+    data = checkForCache(historyFileName(ticker,".json"),expire=-1);
+    if(data==None):
+      data = {}
+    prices = pricesFromDict(data)
 
+  journal = readPriceJournal(ticker)
+  if(journal.shape[1]>0):
+    prices = mergePriceArrays(prices,journal)
+  return prices
 
 
-def getHtml(url):
+
+def pricesFromDict(data):
   """
-  Get a page from the web
+  Turn the old dict-of-dicts keyed by ISO date 
+  into our columnar array.
   """
-  global htmlCache;
-  if(url in htmlCache):
-    return htmlCache[url]
+  days = sorted([k for k in data if k!="N/A"])
+  prices = np.zeros((len(PRICECOLUMNS),len(days)))
+  if(len(days)>0):
+    prices[0] = np.array(days,dtype='datetime64[D]').astype('datetime64[s]').astype(np.int64)
+    for c in range(1,len(PRICECOLUMNS)):
+      col = PRICECOLUMNS[c]
+      prices[c] = [float(data[day][col]) for day in days]
+  return prices
 
-  fn = "caches/web-" + hashlib.sha1(url.encode('utf-8')).hexdigest()
-  page = checkForCachePlain(fn)
 
-  if(page==None):
-    page=""
-    resource = requests.get(url)
-    page += resource.content.decode('utf-8', errors='ignore')
-    resource.close()
 
-    #Save it for cachiness
-    writeFile(fn,page)
+def mergePriceArrays(prices,newPrices):
+  """
+  Lay some new bars over our columnar history.
+  Later bars win, both over the old history and
+  over earlier bars for the same time in newPrices,
+  which is how we replay a journal.
+  """
+  newPrices = newPrices[:,::-1]
+  _, latest = np.unique(newPrices[0],return_index=True)
+  newPrices = newPrices[:,latest]
+  keep = ~np.isin(prices[0],newPrices[0])
+  merged = np.concatenate((prices[:,keep],newPrices),axis=1)
+  return merged[:,np.argsort(merged[0],kind='stable')]
+
 
-  htmlCache[url] = page
-  return page
 
+def changedPriceBars(prices,newPrices):
+  """
+  Which of the freshly fetched bars are actually
+  new or different to the ones we already have?
+  The APIs mostly send us months we already know.
+  """
+  if(prices.shape[1]==0):
+    return newPrices
+  idx = np.minimum(np.searchsorted(prices[0],newPrices[0]),prices.shape[1]-1)
+  old = prices[:,idx]
+  differs = (old!=newPrices) & ~(np.isnan(old) & np.isnan(newPrices))
+  return newPrices[:,differs.any(axis=0)]
 
 
-def checkForCache(cacheFileName,expire=0):
+
+def updatePriceData(ticker,prices,newBars):
   """
-  Check if we have a data-cache and
-  return it if we do
+  Add newly fetched bars to a ticker's history.
+  Only bars that changed get written, appended to
+  the journal, and once that's grown past
+  JOURNALCOMPACTBARS we compact it all back into
+  the main file. newBars is either the old dict
+  of dicts or already columnar.
   """
-  if(expire==0):
-    expire = MAXCACHEAGEHOURS*60*60;
-  now = time.time()
-  yesterday = now-expire;
-  if((os.path.isfile(cacheFileName)) and ((expire<0) or (os.path.getmtime(cacheFileName)>yesterday))):
-    try:
-      data = json.load(open(cacheFileName))
-    except Exception as e:
-      print("Error Doing "+cacheFileName+":"+str(e))
-      exit();
-    return data
+  if(isinstance(newBars,dict)):
+    newBars = pricesFromDict(newBars)
+  changed = changedPriceBars(prices,newBars)
+  if(changed.shape[1]==0):
+    return prices
+  invalidateIndicatorState(ticker,prices,changed)
+  prices = mergePriceArrays(prices,changed)
+
+  if((not os.path.isfile(historyFileName(ticker))) or
+     (priceJournalLength(ticker)+changed.shape[1] > JOURNALCOMPACTBARS)):
+    savePriceData(ticker,prices)
   else:
-    return None
+    appendPriceJournal(ticker,changed)
+  return prices
 
 
 
-def checkForCachePlain(cacheFileName):
+def priceJournalLength(ticker):
   """
-  Check if we have a data-cache and
-  return it if we do
+  How many whole bars are sat in the journal
   """
-  now = time.time()
-  yesterday = now-MAXCACHEAGEHOURS*60*60;
-  if((os.path.isfile(cacheFileName)) and (os.path.getmtime(cacheFileName)>yesterday)):
-    try:
-      ObjRead = open(cacheFileName, "r")
-      data = ObjRead.read()
-      ObjRead.close()
-    except Exception as e:
-      print("Error Doing Plain Cache "+cacheFileName+":"+str(e))
-      exit();
-    return data
-  else:
-    return None
+  fn = historyFileName(ticker,".jnl")
+  if(not os.path.isfile(fn)):
+    return 0
+  return os.path.getsize(fn)//(len(PRICECOLUMNS)*8)
 
 
 
-def getPrices(ticker):
+def readPriceJournal(ticker):
   """
-  Get the entire-history price-date for
-  a given ticker in my format, and call
-  on the API only if we seem to be out of
-  date
+  Read the bars appended since the last compaction.
+  Each record is one bar, PRICECOLUMNS float64s in a
+  row. A half-written record at the end (CTRL-C!) is
+  just ignored.
   """
-  ticker = str(ticker)
-  cacheFileName = "history/"+(ticker.replace("/","__"))+".json"
-  data = checkForCache(cacheFileName,expire=-1);
-  if(data==None):
-    data = {}
+  fn = historyFileName(ticker,".jnl")
+  if(not os.path.isfile(fn)):
+    return np.zeros((len(PRICECOLUMNS),0))
+  n = priceJournalLength(ticker)
+  records = np.fromfile(fn,dtype='<f8',count=n*len(PRICECOLUMNS))
+  return records.reshape((n,len(PRICECOLUMNS))).T
 
-  now = date.today()
-  nowkey = now.isoformat()
-  if((not nowkey in data) or (FetchHistory==True)):
-    data = appendLatestPriceData(ticker,data)
-    savePriceData(ticker,data)
 
-  return data
+
+def appendPriceJournal(ticker,newPrices):
+  """
+  Append bars to the journal. If a previous write
+  was interrupted we first chop off its half-record
+  so everything stays lined up.
+  """
+  fn = historyFileName(ticker,".jnl")
+  recordSize = len(PRICECOLUMNS)*8
+  ObjWrite = open(fn, "ab")
+  size = ObjWrite.tell()
+  if(size % recordSize != 0):
+    ObjWrite.truncate(size - (size % recordSize))
+  ObjWrite.write(np.ascontiguousarray(newPrices.T,dtype='<f8').tobytes())
+  ObjWrite.flush()
+  os.fsync(ObjWrite.fileno())
+  ObjWrite.close()
 
 
 
-def savePriceData(ticker,data):
+def savePriceData(ticker,prices):
   """
   Save the price data of a ticker
   To avoid leaving files half-written
@@ -481,24 +1859,32 @@ def savePriceData(ticker,data):
   write, we write to a "new" file and
   then do a more atomic "mv" to actually
   overwrite the old data.
+  Everything in the journal is in there now, so
+  it goes. If we die before deleting it, it just
+  gets replayed over the same bars next time.
   """
-  cacheFileName = "history/"+(ticker.replace("/","__"))+".json"
-  out=json.dumps(data, indent=2, sort_keys = True )
-  writeFile(cacheFileName, out)
-  
+  writeArrayFile(historyFileName(ticker), prices)
+  jn = historyFileName(ticker,".jnl")
+  if(os.path.isfile(jn)):
+    os.remove(jn)
+
+
 
-def getIndexInDateSeries(timestamp,dateSeries):
+def migrateHistory():
   """
-  Check through a date-series to be sure
-  if a given date is before or after that index
+  One-shot conversion of every old history/*.json
+  file into the columnar format. The JSON is kept
+  as .json.bak in case you want it back.
   """
-  for i in range(0,len(dateSeries)):
-    if(dateSeries[i] == timestamp):
-      return i;
-  return -1;
+  for fn in sorted(os.listdir("history")):
+    if(fn.endswith(".json")):
+      ticker = fn[0:-5].replace("__","/")
+      data = checkForCache("history/"+fn,expire=-1)
+      prices = pricesFromDict(data)
+      savePriceData(ticker,prices)
+      os.rename("history/"+fn,"history/"+fn+".bak")
+      print("Migrated %s: %d bars" % (ticker,prices.shape[1]))
 
-  
- 
 
 def updateTheCsv(filename,pricelist,outhtml):
   """
@@ -555,96 +1941,322 @@ def updateTheCsv(filename,pricelist,outhtml):
 
  
  
-def appendLatestPriceData(ticker,data):
+def getProvider(ticker):
   """
-  Given our current data on the prices of a
-  stock, append some new ones from the latest
-  API call
+  Which API do we get this ticker's prices from?
+  Anything without a crypto exchange suffix is
+  a stock, and goes to yahoo.
   """
   if(ticker.endswith(".DEXSCREENER")):
-    return appendLatestPriceDataDexscreener(ticker,data)
-  if(ticker.endswith(".BINANCE")):
-    return appendLatestPriceDataBinance(ticker,data)
+    return "dexscreener"
+  if(ticker.endswith(".BINANCE") or ticker.endswith(".CRYPTO")):
+    return "binance"
   if(ticker.endswith(".BITFINEX")):
-    return appendLatestPriceDataBitfinex(ticker,data)
+    return "bitfinex"
   if(ticker.endswith(".BITSTAMP")):
-    return appendLatestPriceDataBitstamp(ticker,data)
+    return "bitstamp"
   if(ticker.endswith(".BITTREX")):
-    return appendLatestPriceDataBittrex(ticker,data)
+    return "bittrex"
   if(ticker.endswith(".HUOBI")):
-    return appendLatestPriceDataHuobi(ticker,data)
+    return "huobi"
   if(ticker.endswith(".COINBASE")):
-    return appendLatestPriceDataCoinbase(ticker,data)
-  if(ticker.endswith(".CRYPTO")):
-    return appendLatestPriceDataBinance(ticker,data)
-  return appendLatestPriceDataStocks(ticker,data)
+    return "coinbase"
+  return "yahoo"
+
+
+
+def fetchAllPrices(tickers):
+  """
+  Refresh the price history of every ticker before
+  we start on the checks. Each provider gets its own
+  thread pool, sized from PROVIDERCONCURRENCY, so
+  they all run side by side and the whole fetch takes
+  about as long as the slowest provider. The stocks
+  all go to yahoo as the one batch. The results go
+  in priceCache for runChecks to pick up, and any
+  already there are kept rather than reloaded.
+  Returns how many tickers we fetched.
+  """
+  global priceCache, lastFetched
+  if(lastFetched==None):
+    lastFetched = checkForCache(FETCHEDFILE,expire=-1) or {}
+  fetchedBefore = dict(lastFetched)
+
+  pools = {}
+  futures = []
+  loaded = {}
+  stocks = {}
+  skipped = 0
+  for ticker in tickers:
+    #Nothing new to get? Then we just load it from disk.
+    prices = priceCache.get(ticker)
+    if(prices is None):
+      prices = loadPriceData(ticker)
+    if(not needsRefresh(ticker,prices)):
+      priceCache[ticker] = prices
+      skipped += 1
+      continue
+    provider = getProvider(ticker)
+    if(provider=="yahoo"):
+      stocks[ticker] = prices
+      continue
+    if(not provider in pools):
+      pools[provider] = ThreadPoolExecutor(max_workers=PROVIDERCONCURRENCY.get(provider,2))
+    loaded[ticker] = prices
+    futures.append((ticker,pools[provider].submit(getPrices,ticker,prices)))
+
+  stockFuture = None
+  if(len(stocks)>0):
+    pools["yahoo"] = ThreadPoolExecutor(max_workers=1)
+    stockFuture = pools["yahoo"].submit(getStockPrices,stocks)
+
+  #One ticker going wrong shouldn't stop the rest, they
+  #just get checked on the history we've already got.
+  for ticker,future in futures:
+    try:
+      priceCache[ticker] = future.result()
+    except Exception as e:
+      print("Couldn't update "+ticker+", using the prices we have: "+repr(e))
+      priceCache[ticker] = loaded[ticker]
+  if(stockFuture!=None):
+    try:
+      priceCache.update(stockFuture.result())
+    except Exception as e:
+      print("Couldn't update the stocks, using the prices we have: "+repr(e))
+      priceCache.update(stocks)
+  for provider in pools:
+    pools[provider].shutdown()
+
+  if(LogLevel>=1):
+    print("Fetched %d tickers, %d had no new bar to get" % (len(futures)+len(stocks),skipped))
+  if(lastFetched!=fetchedBefore):
+    writeFile(FETCHEDFILE,json.dumps(lastFetched))
+  return len(futures)+len(stocks)
+
+
+
+def appendLatestPriceData(ticker,data,since=None):
+  """
+  Given our current data on the prices of a
+  stock, append some new ones from the latest
+  API call. since is the time of our last bar,
+  the exchanges that can start from it do, so
+  we're not fetching months we already have.
+  Some exchanges hand back the old dict of dicts,
+  some columns, we always give back columns.
+  """
+  if(ticker.endswith(".DEXSCREENER")):
+    bars = appendLatestPriceDataDexscreener(ticker,data)
+  elif(ticker.endswith(".BINANCE")):
+    bars = appendLatestPriceDataBinance(ticker,data,since)
+  elif(ticker.endswith(".BITFINEX")):
+    bars = appendLatestPriceDataBitfinex(ticker,data,since)
+  elif(ticker.endswith(".BITSTAMP")):
+    bars = appendLatestPriceDataBitstamp(ticker,data)
+  elif(ticker.endswith(".BITTREX")):
+    bars = appendLatestPriceDataBittrex(ticker,data)
+  elif(ticker.endswith(".HUOBI")):
+    bars = appendLatestPriceDataHuobi(ticker,data,since)
+  elif(ticker.endswith(".COINBASE")):
+    bars = appendLatestPriceDataCoinbase(ticker,data)
+  elif(ticker.endswith(".CRYPTO")):
+    bars = appendLatestPriceDataBinance(ticker,data,since)
+  else:
+    bars = appendLatestPriceDataStocks(ticker,data)
+  if(isinstance(bars,dict)):
+    bars = pricesFromDict(bars)
+  return bars
 
 
 def appendLatestPriceDataStocks(ticker,data):
   """
   Given our current data on the prices,
   add the newest data we can get from
-  yfinance
+  yfinance. Really just a batch of one. Any
+  bars already in data go underneath, like the
+  crypto exchanges do it.
   """
-  tickerGroup = getTickerGroup(ticker,TICKERGROUPSIZE)
-  tickerGroupString = ticker
-  if(tickerGroup!=None):
-    tickerGroupString = " ".join(tickerGroup)
+  bars = fetchStockPrices({ticker:loadPriceData(ticker)})[ticker]
+  if(bars is None):
+    bars = np.zeros((len(PRICECOLUMNS),0))
+  if(len(data)>0):
+    bars = mergePriceArrays(pricesFromDict(data),bars)
+  return bars
+
+
+
+def getStockPrices(stocks):
+  """
+  getPrices() for every stale stock at once. Takes
+  {ticker: the history we've already loaded} and
+  gives it back brought up to date. Stocks yahoo
+  didn't answer for at all aren't marked as asked,
+  so next time we still go back to their last bar.
+  """
+  newBars = fetchStockPrices(stocks)
+  for ticker in stocks:
+    if(newBars[ticker] is None):
+      continue
+    if(lastFetched!=None):
+      lastFetched[ticker+intervalSuffix()] = time.time()
+    stocks[ticker] = updatePriceData(ticker,stocks[ticker],newBars[ticker])
+  return stocks
+
 
-  fetched = None
-  fetchedOkay = False;
-  if(tickerGroupString in datCache):
-    fetched = datCache[tickerGroupString]
-  else:
-    for i in range(0,10):
-      if(fetchedOkay==False):
-        try:
-          #time.sleep(60)                 #Stupid method to try and avoid rate limits
-          fetched = yf.download(
-                    tickers = tickerGroupString,
-                    period =   "3mo",    # 1d,5d,1mo,3mo,6mo,1y,2y,5y,10y,ytd,max
-                    interval = "1d",     # 1m,2m,5m,15m,30m,60m,90m,1h,1d,5d,1wk,1mo,3mo
-                    group_by = 'column', # "column", "ticker"
-                    auto_adjust = True,  # True, False. Maybe include splits etc?
-                    prepost = False,     # Include after hours trading? 
-                    threads = False,      # Crikey, they mean to allow a lot at once.
-                    repair=True,
-                    keepna=True,
-                    rounding=True,
-                    proxy = None
-                  )
-          fetchedOkay=True;
-        except:
-          fetchedOkay=False
-          print("Excepted, trying again "+str(i))
-    datCache[tickerGroupString] = fetched
 
+def yahooSymbol(ticker):
+  """
+  What yahoo calls one of our stock tickers,
+  it doesn't want the .O/.N exchange suffixes.
+  """
   ticker = ticker.replace("..",".");
   if((ticker.endswith(".O")) or (ticker.endswith(".N"))):
     ticker = ticker[0:-2]
+  return ticker
+
+
+
+def fetchStockPrices(stocks):
+  """
+  One yf.download for each yahoo group of stocks
+  that start on the same day, from their last
+  stored bar (which we get again, it might have
+  still been forming). Each ticker only keeps bars
+  from its own start on. Returns columnar new bars
+  by ticker, empty if yahoo had nothing, or None
+  if the download failed or didn't include it.
+  """
+  since = {}
+  batches = {}
+  for ticker in stocks:
+    since[ticker] = stockFetchStart(ticker,stocks[ticker])
+    group = getTickerGroup(ticker,"yahoo")
+    start = str(np.datetime64(int(since[ticker]),'s').astype('datetime64[D]'))
+    batches.setdefault((group[0],start),[]).append(ticker)
+
+  ret = {}
+  for (group,start),batch in sorted(batches.items()):
+    symbols = sorted(set([yahooSymbol(t) for t in batch]))
+    fetchStart = time.time()
+    parsed = downloadStocks(symbols,start)
+    for ticker in batch:
+      #Each stock waited for the whole download it was in
+      if(Profile):
+        recordProfile("fetch",ticker,time.time()-fetchStart)
+      bars = parsed.get(yahooSymbol(ticker))
+      if(bars is not None):
+        bars = bars[:,bars[0]>=since[ticker]]
+      ret[ticker] = bars
+  return ret
+
+
+
+def stockFetchStart(ticker,prices):
+  """
+  When do we need a stock's bars from? Its last
+  bar, or YAHOONEWDAYS back if we've none. But
+  if we asked yahoo since then, it had nothing
+  after that bar up to then, so there's no point
+  going back further than YAHOOREFETCHDAYS before
+  we asked. That keeps a delisted or long-stale
+  stock from pulling years of bars every run.
+  """
+  if(prices.shape[1]==0):
+    return time.time()-YAHOONEWDAYS*86400
+  since = prices[0][-1]
+  if(lastFetched!=None):
+    asked = lastFetched.get(ticker+intervalSuffix(),0)
+    since = max(since,asked-YAHOOREFETCHDAYS*86400)
+  return since
+
+
+
+def downloadStocks(symbols,start):
+  """
+  Ask yfinance for daily bars from start for all the
+  symbols, with backoff when it won't play, and split
+  them up by symbol. yfinance mostly hands back an
+  empty frame rather than raise, so that counts as
+  failing too. If yahoo's been given a base URL, it's
+  a --replay-server, which sends us back the frame
+  yfinance gave us when we recorded, as CSV. That
+  still gets split up by parseStockFrame(), only
+  yfinance's own talking to yahoo isn't replayed.
+  """
+  path = "/download?symbols="+",".join(symbols)+"&start="+start
+  wait = 1
+  for i in range(0,YAHOORETRIES):
+    try:
+      if(PROVIDERBASEURLS["yahoo"]!=None):
+        page = getHtml(providerUrl("yahoo",path))
+        pd = lazyImport("pandas")
+        fetched = pd.read_csv(io.StringIO(page),header=[0,1],index_col=0,parse_dates=True)
+        return parseStockFrame(fetched,symbols)
+      yf = lazyImport("yfinance")
+      fetched = yf.download(
+                  tickers = " ".join(symbols),
+                  start =    start,
+                  interval = "1d",     # 1m,2m,5m,15m,30m,60m,90m,1h,1d,5d,1wk,1mo,3mo
+                  group_by = 'column', # "column", "ticker"
+                  auto_adjust = True,  # True, False. Maybe include splits etc?
+                  prepost = False,     # Include after hours trading? 
+                  threads = YAHOOTHREADS,
+                  repair=True,
+                  keepna=True,
+                  rounding=True,
+                  progress=(LogLevel>=1)
+                )
+      if((fetched is not None) and (len(fetched)>0)):
+        if(RecordFixtures):
+          recordFixture("yahoo",path,stockFrameCsv(fetched,symbols))
+        return parseStockFrame(fetched,symbols)
+      print("yfinance sent nothing, trying again in %ds" % wait)
+    except Exception as e:
+      print("yfinance excepted ("+str(e)+"), trying again in %ds" % wait)
+    if(i<YAHOORETRIES-1):
+      time.sleep(wait)
+      wait *= 2
+  return {}
+
+
+
+def stockFrameCsv(fetched,symbols):
+  """
+  yf.download's frame as CSV for a fixture, always
+  with the (field, symbol) columns, even for the one
+  symbol that yfinance sent back without them.
+  """
+  if(fetched.columns.nlevels==1):
+    pd = lazyImport("pandas")
+    fetched = pd.concat({symbols[0]: fetched},axis=1).swaplevel(axis=1)
+  return fetched.to_csv()
+
+
+
+def parseStockFrame(fetched,symbols):
+  """
+  Split yf.download's (field, symbol) columned frame
+  into columnar prices per symbol. Each field comes
+  out as one (bars, symbols) block, and the rows with
+  no open are days that symbol didn't trade.
+  """
+  ret = {}
+  if((fetched is None) or (len(fetched)==0)):
+    return ret
+  t = np.array(fetched.index.strftime("%Y-%m-%d"),dtype='datetime64[D]').astype('datetime64[s]').astype(np.int64)
+  if(fetched.columns.nlevels>1):
+    block = np.array([fetched[f].reindex(columns=symbols).to_numpy(dtype=float) for f in YAHOOFIELDS])
+  else:
+    #One symbol on its own can come back without the symbol level
+    block = np.array([fetched[f].to_numpy(dtype=float).reshape(-1,1) for f in YAHOOFIELDS])
+  for i,symbol in enumerate(symbols):
+    bars = block[:,:,i]
+    traded = ~np.isnan(bars[0])
+    ret[symbol] = np.vstack([t[traded],bars[:,traded]])
+  return ret
+
+
 
-  try:
-   for k in fetched["Close",ticker].keys():
-     dtkey = str(k)
-     dtkey = dtkey[0:10]
-     try:
-       if(not np.isnan(fetched['Open',ticker][k])):
-         data[dtkey] = {
-          'o': float(fetched['Open',ticker][k]),
-          'h': float(fetched['High',ticker][k]),
-          'l': float(fetched['Low',ticker][k]),
-          'c': float(fetched['Close',ticker][k]),
-          'v': float(fetched['Volume',ticker][k])
-         }
-         print(data[dtkey]['o']);
-     except Exception as e:
-        print("Can't get data for "+str(k)+"/"+str(ticker)+" Exception"+str(e));
-  except Exception as e:
-    print("Can't get data for "+str(ticker)+" At All Exception"+str(e));
-  return data
-  
-  
-  
 
 
 def appendLatestPriceDataWorldTradingData(ticker,data):
@@ -657,13 +2269,13 @@ def appendLatestPriceDataWorldTradingData(ticker,data):
   if(FetchHistory):
     return appendOldHistoryToPriceDataWorldTradingData(ticker,data)
 
-  tickerGroup = getTickerGroup(ticker,5)  #We can get five prices at once.
-  tickerGroupString = ",".join(tickerGroup)
+  tickerGroup = getTickerGroup(ticker,"worldtradingdata")
+  tickerGroupString = ",".join([yahooSymbol(t) for t in tickerGroup])
   ticker = ticker.replace("..",".");
   if((ticker.endswith(".O")) or (ticker.endswith(".N"))):
     ticker = ticker[0:-2]
    
-  url = "https://api.worldtradingdata.com/api/v1/stock?symbol="+tickerGroupString+"&api_token="+API_KEY
+  url = providerUrl("worldtradingdata","/api/v1/stock?symbol="+tickerGroupString+"&api_token="+API_KEY)
 
   page = getHtml(url)
   jsondat = json.loads(page)
@@ -695,7 +2307,7 @@ def appendOldHistoryToPriceDataWorldTradingData(ticker,data):
   if((ticker.endswith(".O")) or (ticker.endswith(".N"))):
     ticker = ticker[0:-2]
 
-  url = u"https://api.worldtradingdata.com/api/v1/history?symbol="+ticker+"&api_token="+API_KEY
+  url = providerUrl("worldtradingdata","/api/v1/history?symbol="+ticker+"&api_token="+API_KEY)
 
   page = getHtml(url)
   jsondat = json.loads(page)
@@ -714,6 +2326,67 @@ def appendOldHistoryToPriceDataWorldTradingData(ticker,data):
 
 
 
+def getCandlesSince(url,startParam,since,limit):
+  """
+  The candles from since (our last bar, which
+  we get again in case it was still forming) on, a
+  page of limit at a time. Each page starts a ms
+  after the last candle of the one before, and a
+  short page means we're up to date. Only works for
+  APIs that send candles oldest first as lists with
+  the open time in ms first.
+  """
+  candles = []
+  start = int(since*1000)
+  while(True):
+    page = json.loads(getHtml(url+"&"+startParam+"="+str(start)+"&limit="+str(limit)).strip())
+    if(not isinstance(page,list)):
+      print("Can't get candles from "+url+": "+str(page))
+      break
+    candles += page
+    if(len(page)<limit):
+      break
+    start = int(page[-1][0])+1
+  return candles
+
+
+
+def candlesToPrices(data,rows):
+  """
+  Turn the candles an exchange sent us, rows of
+  [open time in seconds,o,h,l,c,v] in any order,
+  straight into our columnar array, without going
+  through a dict per bar. Any bars already in data
+  (the old dict of dicts) go underneath.
+  """
+  candles = np.array(rows,dtype=float).reshape((-1,len(PRICECOLUMNS)))
+  candles = candles[np.argsort(candles[:,0],kind='stable')]
+  prices = np.vstack([barStarts(candles[:,0]),candles[:,1:].T])
+  if(len(data)>0):
+    prices = mergePriceArrays(pricesFromDict(data),prices)
+  return prices
+
+
+
+def barStarts(seconds):
+  """
+  The time we file each bar under. Daily bars go
+  under their (local) date, like they always have,
+  shorter ones under the start of their interval.
+  The local date is worked out with the one UTC
+  offset, the one we had at the latest bar.
+  """
+  seconds = np.asarray(seconds,dtype=np.int64)
+  if(Interval=="1d"):
+    if(len(seconds)==0):
+      return seconds.astype(float)
+    offset = time.localtime(int(seconds[-1])).tm_gmtoff
+    return ((seconds+offset)//86400*86400).astype(float)
+  step = INTERVALSECONDS[Interval]
+  return (seconds//step*step).astype(float)
+
+
+
 def appendLatestPriceDataBitstamp(ticker,data):
   """
   Given our current data on the prices,
@@ -721,7 +2394,7 @@ def appendLatestPriceDataBitstamp(ticker,data):
   currency version
   """
   ticker = ticker[:-9]
-  url = u"https://www.bitstamp.net/api/v2/ticker/"+ticker+"/"
+  url = providerUrl("bitstamp","/api/v2/ticker/"+ticker+"/")
   page = getHtml(url)
   jsondat = json.loads(page)
   if(jsondat['high']):
@@ -746,7 +2419,7 @@ def appendLatestPriceDataCoinbase(ticker,data):
   """
   ticker = ticker[:-8]
   mkt = ticker[0:3]+"-"+ticker[3:6]
-  url = "https://api.coinbase.com/v2/prices/"+mkt+"/buy"
+  url = providerUrl("coinbase","/v2/prices/"+mkt+"/buy")
   page = getHtml(url)
   jsondat = json.loads(page)
   # {"data":{"base":"BTC","currency":"EUR","amount":"7758.57"}}
@@ -767,32 +2440,26 @@ def appendLatestPriceDataCoinbase(ticker,data):
   return data
 
 
-def appendLatestPriceDataHuobi(ticker,data):
+def appendLatestPriceDataHuobi(ticker,data,since=None):
   """
   Given our current data on the prices,
   add the newest data we can get, crypto-
-  currency version
+  currency version. Huobi can't start from
+  a date, but we can ask for just enough
+  of the latest bars to get back to since.
   """
   ticker = ticker[:-6]
-  url = "https://api.huobi.pro/market/history/kline?period=1day&size=200&symbol="+(ticker.lower())
+  size = 200
+  if(since!=None):
+    size = int(min(max((time.time()-since)//INTERVALSECONDS[Interval]+2,1),HUOBIMAXSIZE))
+  url = providerUrl("huobi","/market/history/kline?period="+PROVIDERINTERVALS["huobi"][Interval]+"&size="+str(size)+"&symbol="+(ticker.lower()))
   page = getHtml(url)
   jsondat = json.loads(page)
   ##First candle is most recent, and so today!?
   if("data" in jsondat):
-    for d in jsondat['data']:
-        ts = d['id']
-        dt = date.fromtimestamp(ts)
-        dtkey = dt.isoformat()
-
-        data[dtkey] = {
-         'o': jsondat['data'][0]['open'],
-         'h': jsondat['data'][0]['high'],
-         'l': jsondat['data'][0]['low'],
-         'c': jsondat['data'][0]['close'],
-         'v': jsondat['data'][0]['vol']
-        }
-  else:
-   print("Warning, can't find Houbi Crypto: "+ticker)
+    rows = [[d['id'],d['open'],d['high'],d['low'],d['close'],d['vol']] for d in jsondat['data']]
+    return candlesToPrices(data,rows)
+  print("Warning, can't find Houbi Crypto: "+ticker)
   return data
 
 
@@ -807,12 +2474,13 @@ def appendLatestPriceDataBittrex(ticker,data):
   mkt = ticker[3:6]+"-"+ticker[0:3]
   if(len(ticker)>6):
     mkt = ticker[4:7]+"-"+ticker[0:4]
-  url = "https://api.bittrex.com/api/v1.1/public/getmarketsummary?market="+mkt
+  url = providerUrl("bittrex","/api/v1.1/public/getmarketsummary?market="+mkt)
   page = getHtml(url)
-  print(str(page))
-  moexit()
-  jsondat = json.loads(page)
-  if((jsondat['success']=="true") or (jsondat['success']==True)):
+  try:
+    jsondat = json.loads(page)
+  except ValueError:
+    jsondat = {}
+  if(isinstance(jsondat,dict) and ((jsondat.get('success')=="true") or (jsondat.get('success')==True)) and (len(jsondat.get('result') or [])>0)):
     now = date.today()
     nowkey = now.isoformat()
     data[nowkey] = {
@@ -829,34 +2497,29 @@ def appendLatestPriceDataBittrex(ticker,data):
 
 
 
-def appendLatestPriceDataBitfinex(ticker,data):
+def appendLatestPriceDataBitfinex(ticker,data,since=None):
   """
   Given our current data on the prices,
   add the newest data we can get, crypto-
   currency version
   """
   ticker = ticker[:-9]
-  page = getHtml("https://api-pub.bitfinex.com/v2/candles/trade:1D:t"+ticker+"/hist")
-  jsondat = json.loads(str(page))
-  if(len(jsondat)>0):
-    for dat in jsondat:
-      timestamp = dat[0]/1000
-      dt = date.fromtimestamp(timestamp)
-      dtkey = dt.isoformat()
-      
-      data[dtkey] = {
-       'o': dat[1],
-       'c': dat[2],
-       'h': dat[3],
-       'l': dat[4],
-       'v': dat[5],
-      }
+  url = providerUrl("bitfinex","/v2/candles/trade:"+PROVIDERINTERVALS["bitfinex"][Interval]+":t"+ticker+"/hist")
+  if(since!=None):
+    jsondat = getCandlesSince(url+"?sort=1","start",since,BITFINEXPAGE)
+  else:
+    jsondat = json.loads(str(getHtml(url)))
+  #Errors come back as ["error",code,message]
+  if((len(jsondat)>0) and isinstance(jsondat[0],list)):
+    #Bitfinex sends close before high and low
+    rows = [[dat[0]/1000,dat[1],dat[3],dat[4],dat[2],dat[5]] for dat in jsondat]
+    return candlesToPrices(data,rows)
   return data
 
 
 
 
-def appendLatestPriceDataBinance(ticker,data):
+def appendLatestPriceDataBinance(ticker,data,since=None):
   """
   Given our current data on the prices,
   add the newest data we can get, crypto-
@@ -871,30 +2534,23 @@ def appendLatestPriceDataBinance(ticker,data):
     symbol+="T"
   if(symbol=="GBPUSD"):
     symbol ="GBPBUSD"
-  url = u"https://api.binance.com/api/v1/klines?symbol="+symbol+"&interval=1d"
-  page = getHtml(url).strip()
+  url = providerUrl("binance","/api/v1/klines?symbol="+symbol+"&interval="+PROVIDERINTERVALS["binance"][Interval])
   binanceJson=""
   try:
-      binanceJson = json.loads(page)
+      if(since!=None):
+        binanceJson = getCandlesSince(url,"startTime",since,BINANCEPAGE)
+      else:
+        binanceJson = json.loads(getHtml(url).strip())
+  except FetchError:
+      raise
   except Exception as e:
-      print(page)
       print("Can't load JSON for "+str(ticker)+":"+str(e)+" "+url)
       exit();
  
 
-  if(len(binanceJson)>0):
-    for dat in binanceJson:
-      timestamp = dat[0]/1000
-      dt = date.fromtimestamp(timestamp)
-      dtkey = dt.isoformat()
-      
-      data[dtkey] = {
-       'o': dat[1],
-       'h': dat[2],
-       'l': dat[3],
-       'c': dat[4],
-       'v': dat[5],
-      }
+  if(isinstance(binanceJson,list) and (len(binanceJson)>0)):
+    rows = [[dat[0]/1000]+dat[1:6] for dat in binanceJson]
+    return candlesToPrices(data,rows)
   return data
 
 
@@ -910,17 +2566,27 @@ def appendLatestPriceDataDexscreener(ticker,data):
     return data
 
   symbol = bits[0]; 
-  url = u"https://api.dexscreener.com/latest/dex/pairs/"+symbol
+
+  #The pairs on one chain get asked for all at once, the
+  #rest of the group pick the same page out of the cache.
+  group = [t.split(".")[0] for t in getTickerGroup(ticker,"dexscreener")]
+  url = providerUrl("dexscreener","/latest/dex/pairs/"+symbol)
+  if(("/" in symbol) and (len(group)>1)):
+    url = providerUrl("dexscreener","/latest/dex/pairs/"+symbol.split("/")[0]+"/"+",".join([g.split("/",1)[1] for g in group]))
   page = getHtml(url)
   dexJson = json.loads(page)
 
   if(len(dexJson)>0):
-    print(url+":"+str(dexJson))
+    if(LogLevel>=2):
+      print(url+":"+str(dexJson))
     if(('pairs' in dexJson) and (dexJson['pairs']!=None)):
-      if(len(dexJson['pairs'])>0):
-          if('priceUsd' in dexJson['pairs'][0]):
-            opn = dexJson['pairs'][0]['priceUsd']
-            vol = dexJson['pairs'][0]['volume']['h24']
+      pairs = [p for p in dexJson['pairs'] if p.get('pairAddress','').lower()==symbol.split("/")[-1].lower()]
+      if((len(pairs)==0) and (len(group)<=1)):
+        pairs = dexJson['pairs']
+      if(len(pairs)>0):
+          if('priceUsd' in pairs[0]):
+            opn = pairs[0]['priceUsd']
+            vol = pairs[0]['volume']['h24']
             timestamp = time.time()
             dt = date.fromtimestamp(timestamp)
             dtkey = dt.isoformat()
@@ -938,130 +2604,386 @@ def appendLatestPriceDataDexscreener(ticker,data):
 
 
 
-def getSeries(prices,ohlc="c"):
+def aggregateBars(prices,seconds,shift=0):
+  """
+  Build longer bars out of the stored ones in one go:
+  bucket them by (time+shift)//seconds and take the
+  first open, highest high, lowest low, last close
+  and the total volume of each. Each new bar is timed
+  at the start of its bucket.
+  """
+  if(prices.shape[1]==0):
+    return np.zeros((len(PRICECOLUMNS),0))
+  buckets = (prices[0].astype(np.int64)+shift)//seconds
+  starts = np.flatnonzero(np.concatenate(([True],buckets[1:]!=buckets[:-1])))
+  ends = np.concatenate((starts[1:],[len(buckets)]))-1
+  return np.vstack([
+    (buckets[starts]*seconds-shift).astype(float),
+    prices[1][starts],
+    np.maximum.reduceat(prices[2],starts),
+    np.minimum.reduceat(prices[3],starts),
+    prices[4][ends],
+    np.add.reduceat(prices[5],starts),
+  ])
+
+
+
+def checkPrices(prices):
+  """
+  The bars the checks run on: the stored ones, or
+  built up from them if --timeframe is longer.
+  """
+  if((CheckTimeframe==None) or (CheckTimeframe==Interval)):
+    return prices
+  return aggregateBars(np.asarray(prices,dtype=float),INTERVALSECONDS[CheckTimeframe])
+
+
+
+def getSeries(prices,ohlc="c"):
+  """
+  Turn our price-data in to simple series,
+  all in one go with numpy. We get the daily
+  open, high, low, close and volume, the same
+  resampled into Monday-to-Sunday weeks (wo,
+  wh, wl, wc and wv), and dseries and wseries
+  for whichever of those ohlc asks for. Also
+  dateSeries, the ISO date of each daily bar,
+  a dateIndex to look bars up by date, and
+  weekOf, each daily bar's index in the weeks.
+  """
+  if((prices is None)or(prices.shape[1]==0)):
+    prices = np.zeros((len(PRICECOLUMNS),0))
+
+  series = {}
+  days = prices[0].astype(np.int64)//86400
+  weeks = (days+3)//7     #1970-01-01 was a Thursday
+  newWeek = np.concatenate(([True],weeks[1:]!=weeks[:-1])) if len(days)>0 else np.zeros(0,dtype=bool)
+  starts = np.flatnonzero(newWeek)
+  ends = np.concatenate((starts[1:],[len(days)]))-1
+
+  for col in PRICECOLUMNS[1:]:
+    series[col] = np.asarray(prices[PRICECOLUMNS.index(col)],dtype=float)
+  if(len(starts)>0):
+    series['wo'] = series['o'][starts]
+    series['wh'] = np.maximum.reduceat(series['h'],starts)
+    series['wl'] = np.minimum.reduceat(series['l'],starts)
+    series['wc'] = series['c'][ends]
+    series['wv'] = np.add.reduceat(series['v'],starts)
+  else:
+    for col in PRICECOLUMNS[1:]:
+      series['w'+col] = np.zeros(0)
+
+  series['dseries'] = series[ohlc]
+  series['wseries'] = series['w'+ohlc]
+  series['dateSeries'] = np.datetime_as_string(days.astype('datetime64[D]')).tolist()
+  series['dateIndex'] = dict(zip(series['dateSeries'],range(0,len(days))))
+  series['weekOf'] = np.cumsum(newWeek)-1
+  return series
+
+
+
+def weeksAgo(ind,daysAgo):
+  """
+  How many weeks back, from the end of the weekly
+  series, is the week holding the daily bar daysAgo
+  bars back? Works on a whole array of days too.
+  Before the first bar it's a week nothing has.
+  """
+  nowIdx = len(ind['dseries'])-np.asarray(daysAgo)-1
+  w = len(ind['wseries'])-1-ind['weekOf'][np.maximum(nowIdx,0)]
+  return np.where(nowIdx>=0, w, len(ind['wseries'])+1)
+
+  
+def calculateEma(nseries,n=25):
+  """
+  Calculate an exponential Moving Average
+  """
+  if(len(nseries)<n):
+    n=len(nseries)
+  pd = lazyImport("pandas")
+  ret = pd.Series(nseries).ewm(span=n).mean().tolist()
+  for i in range(0,min(n,len(nseries))):
+    ret[i] = float("NaN")
+  return ret
+ 
+
+
+def calculateMa(nseries,n=25):
+  """
+  Calculate a Moving Average
+  """
+  if(len(nseries)<n):
+    n=len(nseries)
+  pd = lazyImport("pandas")
+  return pd.Series(nseries).rolling(n).mean().tolist()
+
+
+
+def calculateSequential(series,n=4):
+  """
+  Calculate a basic TD (ish) sequential,
+  We just count the main number
+  """
+  return calculateSequentialBatch(np.atleast_2d(np.asarray(series,dtype=float)),n)[0]
+
+
+
+def calculateSequentialBatch(matrix,n=4):
+  """
+  The sequential count for a whole matrix of
+  series at once, one series per row, all the
+  same length. Each bar counts up while it's
+  above the close n bars back (down otherwise)
+  and the count wraps round after 9, so it's
+  just the length of the current run, mod 9.
+  """
+  matrix = np.asarray(matrix,dtype=float)
+  rows, length = matrix.shape
+  ret = np.zeros((rows,max(n,length)),dtype=int)
+  if(length<=n):
+    return ret
+  up = matrix[:,n:] > matrix[:,:-n]
+  idx = np.arange(length-n)
+  lastDown = np.maximum.accumulate(np.where(up,-1,idx),axis=1)
+  lastUp = np.maximum.accumulate(np.where(up,idx,-1),axis=1)
+  countup = (idx-lastDown-1)%9+1
+  countdown = (idx-lastUp-1)%9+1
+  ret[:,n:] = np.where(up,countup,-countdown)
+  return ret
+   
+
+
+def calculateRsi(nseries,n=14):
+  """
+  Calculate an RSI 
+  """
+  return calculateRsiBatch(np.atleast_2d(np.asarray(nseries,dtype=float)),n)[0]
+
+
+
+def calculateRsiBatch(matrix,n=14):
+  """
+  RSIs for a whole matrix of series at once, one
+  series per row, all the same length.
+  """
+  up, down = rsiAveragesBatch(matrix,n)
+  return rsiFromAverages(up,down)
+
+
+
+def rsiAveragesBatch(matrix,n=14):
+  """
+  The smoothed average up and down moves behind
+  the RSI at every bar. We seed the averages from
+  the first n+1 moves and then do the usual Wilder
+  smoothing of the up and down moves.
+  """
+  matrix = np.asarray(matrix,dtype=float)
+  deltas = np.diff(matrix,axis=1)
+  seed = deltas[:,:n+1]
+  up = np.zeros_like(matrix)
+  down = np.zeros_like(matrix)
+  #Summed just the moves, like always, so the rounding's the same
+  up[:,:n] = np.array([s[s>=0].sum()/n for s in seed])[:,None]
+  down[:,:n] = np.array([-s[s<0].sum()/n for s in seed])[:,None]
+  if(matrix.shape[1]>n):
+    moves = deltas[:,n-1:]
+    up[:,n:] = wilderSmooth(np.where(moves>0,moves,0.),up[:,0],n)
+    down[:,n:] = wilderSmooth(np.where(moves>0,0.,-moves),down[:,0],n)
+  return up, down
+
+
+
+def rsiFromAverages(up,down):
+  """
+  Turn average up/down moves into an RSI, if there
+  were no down moves we use the up average as RS.
+  """
+  rs = np.divide(up,down,out=np.array(up,dtype=float),where=(down!=0))
+  return 100.0 - 100.0/(1.0+rs)
+
+
+
+def wilderSmooth(values,seed,n):
+  """
+  Wilder's smoothing along each row of values,
+  starting from seed: y = (y*(n-1) + x)/n
+  It's done a step at a time on plain floats, the
+  same sums in the same order as the old loop, so
+  the RSIs are exactly what they always were and an
+  RSI sat right on 70 or 30 can't flip. Unrolling it
+  into a cumsum is quicker but off in the last bits.
+  """
+  values = np.asarray(values,dtype=float)
+  out = np.empty_like(values)
+  for r in range(0,values.shape[0]):
+    y = float(seed[r])
+    row = []
+    for x in values[r].tolist():
+      y = (y*(n-1) + x)/n
+      row.append(y)
+    out[r] = row
+  return out
+  
+
+
+def getStreamedIndicators(ticker,closes,periods):
+  """
+  For the daily run we only need the last two values
+  of each daily indicator, so rather than recalculate
+  everything from bar 0 we keep the indicators' running
+  state alongside the history and move it on by
+  however many bars arrived since last time.
+  The saved state stops at the second last bar, as 
+  today's bar is often still changing, and we step
+  the last bar on top without saving it.
+  The MA sums get added to and taken from every bar,
+  so we sum their windows again each time rather
+  than let the rounding build up over a long daemon.
+  Returns two-bar arrays keyed like runChecks' ones.
+  """
+  fn = historyFileName(ticker,".state.json")
+  last = len(closes)-2
+  state = indicatorStates.get(ticker)
+  if(state==None):
+    state = checkForCache(fn,expire=-1)
+  if(not indicatorStateUsable(state,closes,periods)):
+    state = buildIndicatorState(closes,last,periods)
+    writeFile(fn,json.dumps(state))
+  elif(state['n']-1<last):
+    for i in range(state['n'],last+1):
+      stepIndicatorState(state,closes,i)
+    resumMaState(state,closes)
+    writeFile(fn,json.dumps(state))
+  else:
+    resumMaState(state,closes)
+  indicatorStates[ticker] = state
+
+  prev = indicatorStateValues(state)
+  state = copy.deepcopy(state)
+  stepIndicatorState(state,closes,last+1)
+  now = indicatorStateValues(state)
+  return {k: np.array([prev[k],now[k]]) for k in prev}
+
+
+
+def indicatorStateUsable(state,closes,periods):
   """
-  Turn our price-data in to a simple
-  series. We want a weekly series as
-  well as the daily series, and best
-  return the number of days in those
-  weeks too.
-  """
-  addedWeek=False
-  dseries = []
-  wseries = []
-  dateSeries = []
-  lastDay = 0
-  weekLen = 1
-  lastp = 0
-  p = 0
-  if((prices!=None)and(len(prices)>0)):
-      for day in sorted(prices):
-        addedWeek=False
-        lastp = p
-        dateSeries.append(day)
-        p = float(prices[day][ohlc])
-        dseries.append(p)
-
-        #If a stock ceases trading, then get get N/A as 
-        #a date
-        if(day!="N/A"):
-          d = dateutil.parser.isoparse(day)
-          newDay = d.weekday()
-          if(newDay < lastDay):
-            #start of new week, so add the last week to the weekly series
-            addedWeek=True
-            wseries.append(lastp)
-            if(weekLen<lastDay):
-              weekLen = lastDay+1
-          lastDay = newDay
-
-      if(not addedWeek):
-        wseries.append(lastp)
-
-  return dseries, wseries, dateSeries, weekLen
+  Can we carry on from a saved indicator state? Not if
+  it's for different periods or it's beyond the end of
+  the history or the bar it stopped on has changed.
+  """
+  if(state==None):
+    return False
+  for kind in periods:
+    for n in periods[kind]:
+      if(not str(n) in state[kind]):
+        return False
+  k = state['n']-1
+  return (k < len(closes)-1) and (closes[k]==state['c'])
 
-  
-def calculateEma(nseries,n=25):
+
+
+def buildIndicatorState(closes,k,periods):
   """
-  Calculate an exponential Moving Average
+  Work out the indicator state as of bar k the
+  slow way, from the vectorised calculations over
+  the whole history up to there.
   """
-  if(len(nseries)<n):
-    n=len(nseries)
-  ret = pd.Series(nseries).ewm(span=n).mean().tolist()
-  for i in range(0,min(n,len(nseries))):
-    ret[i] = float("NaN")
-  return ret
- 
+  series = np.asarray(closes[:k+1],dtype=float)
+  state = {'n': k+1, 'c': float(series[k]), 'ema': {}, 'ma': {}, 'rsi': {}, 'seq': {}}
+  for n in periods['ema']:
+    a = 2.0/(n+1.0)
+    den = (1.0-(1.0-a)**(k+1))/a
+    state['ema'][str(n)] = [float(lazyImport("pandas").Series(series).ewm(span=n).mean().iloc[-1])*den, den]
+  for n in periods['ma']:
+    state['ma'][str(n)] = float(np.sum(series[max(0,k-n+1):]))
+  for n in periods['rsi']:
+    up, down = rsiAveragesBatch(series[None,:],n)
+    state['rsi'][str(n)] = [float(up[0,-1]), float(down[0,-1])]
+  for n in periods['seq']:
+    seq = int(calculateSequential(series,n)[k])
+    state['seq'][str(n)] = [max(seq,0), max(-seq,0)]
+  return state
+
+
+
+def resumMaState(state,closes):
+  """
+  Sum each MA's window afresh from the closes, up to
+  the bar the state is at, like buildIndicatorState.
+  """
+  k = state['n']-1
+  for n in state['ma']:
+    state['ma'][n] = float(np.sum(np.asarray(closes[max(0,k-int(n)+1):k+1],dtype=float)))
 
 
-def calculateMa(nseries,n=25):
+
+def stepIndicatorState(state,closes,i):
   """
-  Calculate a Moving Average
+  Move the indicator state on by one bar, to bar i.
+  Each indicator is O(1): EMAs keep their weighted
+  sum and sum of weights, MAs a running sum, RSIs 
+  the Wilder averages and sequentials their counts.
   """
-  if(len(nseries)<n):
-    n=len(nseries)
-  return pd.Series(nseries).rolling(n).mean().tolist()
+  x = float(closes[i])
+  for n in state['ema']:
+    a = 2.0/(int(n)+1.0)
+    num, den = state['ema'][n]
+    state['ema'][n] = [(1-a)*num + x, (1-a)*den + 1]
+  for n in state['ma']:
+    state['ma'][n] += x - float(closes[i-int(n)])
+  for n in state['rsi']:
+    up, down = state['rsi'][n]
+    delta = x - float(closes[i-1])
+    upval = delta if delta>0 else 0.
+    downval = 0. if delta>0 else -delta
+    state['rsi'][n] = [(up*(int(n)-1) + upval)/int(n), (down*(int(n)-1) + downval)/int(n)]
+  for n in state['seq']:
+    countup, countdown = state['seq'][n]
+    if(x > float(closes[i-int(n)])):
+      countdown = 0
+      countup = countup%9 + 1
+    else:
+      countup = 0
+      countdown = countdown%9 + 1
+    state['seq'][n] = [countup, countdown]
+  state['n'] = i+1
+  state['c'] = x
 
 
 
-def calculateSequential(series,n=4):
+def indicatorStateValues(state):
   """
-  Calculate a basic TD (ish) sequential,
-  We just count the main number
+  The indicator values at the bar the state is at,
+  keyed like runChecks' indicators: ema20, ma25, rsi14...
   """
-  ret = []
-  countup=0
-  countdown=0
-  seq = 0
-  for i in range(0,n):
-    ret.append(seq)
-  for i in range(n, len(series)):
-    if(series[i] > series[i-n]):
-      countdown=0
-      countup+=1
-      if(countup>9):
-       countup=1
-      seq = countup
-    else:
-      countup=0
-      countdown+=1
-      if(countdown>9):
-       countdown=1
-      seq=-countdown
-    ret.append(seq)
+  ret = {}
+  for n in state['ema']:
+    ret['ema'+n] = state['ema'][n][0]/state['ema'][n][1]
+  for n in state['ma']:
+    ret['ma'+n] = state['ma'][n]/int(n)
+  for n in state['rsi']:
+    ret['rsi'+n] = float(rsiFromAverages(np.array(state['rsi'][n][0]),np.array(state['rsi'][n][1])))
+  for n in state['seq']:
+    countup, countdown = state['seq'][n]
+    ret['seq'+n] = countup if countup>0 else -countdown
   return ret
-   
 
 
-def calculateRsi(nseries,n=14):
+
+def invalidateIndicatorState(ticker,prices,changed):
   """
-  Calculate an RSI 
+  If bars the saved indicator state has already 
+  been through got revised, throw it away so it
+  gets rebuilt next time.
   """
-  deltas = np.diff(nseries)
-  seed = deltas[:n+1]
-  up = seed[seed>=0].sum()/n
-  down = -seed[seed<0].sum()/n
-  rs = up
-  if(down!=0): 
-    rs = up/down
-  rsi = np.zeros_like(nseries)
-  rsi[:n] = 100.0 - 100.0/(1.0+rs)
-  for i in range(n, len(nseries)):
-    delta = deltas[i-1]
-    if delta>0:
-        upval = delta
-        downval = 0.
-    else:
-        upval = 0.
-        downval = -delta
-    up = (up*(n-1) + upval)/n
-    down = (down*(n-1) + downval)/n
-    rs = up
-    if(down!=0): 
-      rs = up/down
-    rsi[i] = 100. - 100./(1.+rs)
-  return rsi
-  
+  fn = historyFileName(ticker,".state.json")
+  state = checkForCache(fn,expire=-1)
+  if((state!=None) and (state['n']<=prices.shape[1]) and (changed[0].min()<=prices[0,state['n']-1])):
+    os.remove(fn)
+    indicatorStates.pop(ticker,None)
+
 
 
 def doAlert(bullchange,ticker,uniqcode,message,daysAgo=0):
@@ -1112,6 +3034,48 @@ def doAlert(bullchange,ticker,uniqcode,message,daysAgo=0):
   return True
 
 
+def getTickerPeriods(ticker):
+  """
+  The EMA and MA periods for a ticker, the defaults
+  unless tickers.txt gave it some of its own.
+  """
+  periods = {
+    'ema1': 20, 'ema2': 50, 'ema3': 100, 'ema4': 200,
+    'ma1': 25, 'ma2': 50, 'ma3': 100, 'ma4': 200,
+  }
+  if(ticker in tickerParams):
+    p = tickerParams[ticker]
+    names = ['ema1','ema2','ema3','ema4','ma1','ma2','ma3','ma4']
+    for i in range(0,min(len(p),len(names))):
+      if(p[i].isnumeric()):
+        periods[names[i]] = int(p[i])
+  return periods
+
+
+
+def resetRunState(keepCaches=False):
+  """
+  Empty everything a run of the checks piles up,
+  ready for another run in the same process. The
+  prices, pages and indicator states we've loaded
+  can be kept, as they look after themselves.
+  """
+  global alerts, uniqcodes, resultLog, betRecords, priceCache, htmlCache, indicatorStates
+  global bullishness, bullishness_tops, bullishness_bots
+  global bullreason, bullreason_tops, bullreason_bots
+  alerts = []
+  uniqcodes = {}
+  resultLog = newResultLog()
+  betRecords = []
+  if(not keepCaches):
+    priceCache = {}
+    htmlCache = {}
+    indicatorStates = {}
+  bullishness, bullishness_tops, bullishness_bots = {}, {}, {}
+  bullreason, bullreason_tops, bullreason_bots = {}, {}, {}
+
+
+
 def runChecks(tickers):
   """
   Update all our data and run the checks,
@@ -1119,41 +3083,30 @@ def runChecks(tickers):
   for all tickers.
   """
   global LogLevel, Backtestdays, ShowGraphs, Checks
-  global BetStore, PlaceBetArgs, tickerParams, bullishness, bullreason
+  global BetStore, PlaceBetArgs, tickerParams
   outTable = []
   latestPrices = {}
   for ticker in tickers:
+    if(Profile):
+      tickerStart, tickerPeak = time.time(), peakMemory()
     tickername=ticker;
     if(ticker.endswith(".DEXSCREENER")):
       bts = ticker.split(".")
       tickername=bts[1]
-    ema1 = 20
-    ema2 = 50
-    ema3 = 100
-    ema4 = 200
-    ma1 = 25
-    ma2 = 50
-    ma3 = 100
-    ma4 = 200
-
-    if(ticker in tickerParams):
-      p = tickerParams[ticker]
-      l = len(p)
-      if((l>0) and (p[0].isnumeric())):ema1=int(p[0]);
-      if((l>1) and (p[1].isnumeric())):ema2=int(p[1]);
-      if((l>2) and (p[2].isnumeric())):ema3=int(p[2]);
-      if((l>3) and (p[3].isnumeric())):ema4=int(p[3]);
-      if((l>4) and (p[4].isnumeric())):ma1=int(p[4]);
-      if((l>5) and (p[5].isnumeric())):ma2=int(p[5]);
-      if((l>6) and (p[6].isnumeric())):ma3=int(p[6]);
-      if((l>7) and (p[7].isnumeric())):ma4=int(p[7]);
+    periods = getTickerPeriods(ticker)
+    ema1, ema2, ema3, ema4 = periods['ema1'], periods['ema2'], periods['ema3'], periods['ema4']
+    ma1, ma2, ma3, ma4 = periods['ma1'], periods['ma2'], periods['ma3'], periods['ma4']
 
     price = -1
     score = 0
     highestDayscore = 0
     highestDayscoreDay = 0
-    prices = getPrices(ticker)
-    dseries, wseries, dateSeries, wlen = getSeries(prices,"c")
+    if(ticker in priceCache):
+      prices = priceCache[ticker]
+    else:
+      prices = getPrices(ticker)
+    series = getSeries(checkPrices(prices),"c")
+    dseries, wseries, dateSeries = series['dseries'], series['wseries'], series['dateSeries']
 
 
     if(PlaceBetArgs!=None):
@@ -1165,177 +3118,58 @@ def runChecks(tickers):
       price = latestPrices[tickername] = dseries[-1]
 
       #Some indicators
-      rsi  = calculateRsi(dseries,14);
-      w_rsi= calculateRsi(wseries,14);
-      ma1s = calculateMa(dseries,ma1);
-      ma2s = calculateMa(dseries,ma2);
-      ma3s = calculateMa(dseries,ma3);
-      ma4s = calculateMa(dseries,ma4);
-      ema1s = calculateEma(dseries,ema1);
-      ema2s = calculateEma(dseries,ema2);
-      ema3s = calculateEma(dseries,ema3);
-      ema4s = calculateEma(dseries,ema4);
-      seq  = calculateSequential(dseries,4)
-      w_seq= calculateSequential(wseries,4)
-
-      #Check every day in the range.
-      for d in range(BacktestDays,-1,-1):   #d = daysAgo
-        bullishness={}
-        bullreason ={}
-
-        dayscore=0
-        #TODO: this date calculation is aproximate. Calendars are a fucking nightmare.
-        #we need to account for holidays and otherwise hissing data etc.
-        w = int(math.ceil(float(d)/float(wlen)))
-
-        #Daily-candles checks if we have enough data 
-        if(len(dseries)>0):
-          #RSI
-          if("rsi" in Checks):
-            diff,isNew = checkRsi(rsi,d,ticker,"Daily",d)
-            score += diff
-            dayscore += diff
-            if(isNew):
-              logResult(ticker,d,"rsi",diff,dseries)
-
-          #MA cross
-          if(("max1" in Checks) and ("max2" in Checks)):
-            diff,isNew = checkMaCross(ma1s,ma2s,d,ticker,"Short %d vs Med %d"%(ma1,ma2))
-            score += diff
-            dayscore += diff
-            if(isNew):
-              logResult(ticker,d,"max12",diff,dseries)
-          if(("max1" in Checks) and ("max3" in Checks)):
-            diff,isNew = checkMaCross(ma1s,ma3s,d,ticker,"Short %d vs %d Long"%(ma1,ma2))
-            score += diff
-            dayscore += diff
-            if(isNew):
-              logResult(ticker,d,"max13",diff,dseries)
-          if(("max1" in Checks) and ("max4" in Checks)):
-            diff,isNew = checkMaCross(ma1s,ma4s,d,ticker,"Short %d vs %d VLong"%(ma1,ma4))
-            score += diff
-            dayscore += diff
-            if(isNew):
-              logResult(ticker,d,"max14",diff,dseries)
-          if(("max2" in Checks) and ("max3" in Checks)):
-            diff,isNew = checkMaCross(ma2s,ma3s,d,ticker,"Med %d vs %d Long"%(ma2,ma3))
-            score += diff
-            dayscore += diff
-            if(isNew):
-              logResult(ticker,d,"max23",diff,dseries)
-          if(("max2" in Checks) and ("max4" in Checks)):
-            diff,isNew = checkMaCross(ma2s,ma4s,d,ticker,"Med %d vs %d VLong"%(ma2,ma4))
-            score += diff
-            dayscore += diff
-            if(isNew):
-              logResult(ticker,d,"max24",diff,dseries)
-          if(("max3" in Checks) and ("max4" in Checks)):
-            diff,isNew = checkMaCross(ma3s,ma4s,d,ticker,"Long %d vs %d VLong"%(ma3,ma4))
-            score += diff
-            dayscore += diff
-            if(isNew):
-              logResult(ticker,d,"max34",diff,dseries)
-
-          #EMA cross
-          if(("emax1" in Checks) and ("emax2" in Checks)):
-            diff,isNew = checkMaCross(ema1s,ema2s,d,ticker,"Exp-Short %d vs Med %d"%(ema1,emas))
-            score += diff
-            dayscore += diff
-            if(isNew):
-              logResult(ticker,d,"emax12",diff,dseries)
-          if(("emax1" in Checks) and ("emax3" in Checks)):
-            diff,isNew = checkMaCross(ema1s,ema3s,d,ticker,"Exp-Short %d vs Long %d"%(ema11,ema3))
-            score += diff
-            dayscore += diff
-            if(isNew):
-              logResult(ticker,d,"emax13",diff,dseries)
-          if(("emax1" in Checks) and ("emax4" in Checks)):
-            diff,isNew = checkMaCross(ema1s,ema4s,d,ticker,"Exp-Short %d vs VLong %d"%(ema1,ema4))
-            score += diff
-            dayscore += diff
-            if(isNew):
-              logResult(ticker,d,"emax14",diff,dseries)
-          if(("emax2" in Checks) and ("emax3" in Checks)):
-            diff,isNew = checkMaCross(ema2s,ema3s,d,ticker,"Exp-Med %d vs Long %d"%(ema2,ema3))
-            score += diff
-            dayscore += diff
-            if(isNew):
-              logResult(ticker,d,"emax23",diff,dseries)
-          if(("emax2" in Checks) and ("emax4" in Checks)):
-            diff,isNew = checkMaCross(ema2s,ema4s,d,ticker,"Exp-Med %d vs VLong %d"%(ema2,ema4))
-            score += diff
-            dayscore += diff
-            if(isNew):
-              logResult(ticker,d,"emax24",diff,dseries)
-          if(("emax3" in Checks) and ("emax4" in Checks)):
-            diff,isNew = checkMaCross(ema3s,ema4s,d,ticker,"Exp-Long %d vs %d Vlong"%(ema3,ema4))
-            score += diff
-            dayscore += diff
-            if(isNew):
-              logResult(ticker,d,"emax34",diff,dseries)
-
-          #Sequential Nines
-          if("seq" in Checks):
-            diff,isNew = checkSequential(seq,d,ticker,"d",d)
-            score += diff
-            dayscore += diff
-            if(isNew):
-              logResult(ticker,d,"seq",diff,dseries)
-
-          #MASort -> Are the moving averages sorted into bull/bear order?
-          if("masort" in Checks):
-            diff,isNew = checkMASort(ma1s,ma2s,ma3s,ma4s,d,ticker,"MA")
-            score += diff
-            dayscore += diff
-            if(isNew):
-              logResult(ticker,d,"masort",diff,dseries)
-
-          #MASort -> Are the moving averages sorted into bull/bear order?
-          if("emasort" in Checks):
-            diff,isNew = checkMASort(ema1s,ema2s,ema3s,ema4s,d,ticker,"EMA")
-            score += diff
-            dayscore += diff
-            if(isNew):
-              logResult(ticker,d,"emasort",diff,dseries)
-
-         
-        #Weekly-candles checks if we have enough data, cecking weekly candles every day.
-        if(len(wseries)>0):
-          #Weekly RSI
-          if("rsi_w" in Checks):
-            diff,isNew = checkRsi(w_rsi,w,ticker,"Weekly",d)
-            score += diff
-            dayscore += diff
-            if(isNew):
-              logResult(ticker,d,"rsi_w",diff,dseries)
-
-          #Weekly Sequential Nines
-          if("seq_w" in Checks):
-            diff,isNew = checkSequential(w_seq,w,ticker,"w",d)
-            score += diff
-            dayscore += diff
-            if(isNew):
-              logResult(ticker,d,"seq_w",diff,dseries)
-
-        #Multi doesn't add to score, can only be checked after all tests
-        if("multi" in Checks):
-          if(dayscore>=MultiCheck):
-            logResult(ticker,d,"multi",+1,dseries)
-          if(dayscore<=-MultiCheck):
-            logResult(ticker,d,"multi",-1,dseries)
-
-        #Bet-alerting doesn't add to scores coz it's the *end* of the bet.
-        if("bets" in Checks):
-          diff,isNew = checkBetExpire(dateSeries,dseries,d,ticker)
-          if(isNew):
-            logResult(ticker,d,"bet_%s"%("w" if diff>1 else "l"),diff,dseries)
-          
-
-        #Control randomness doesn't add to score either.
-        if("ctrl" in Checks):
-          diff,isNew = checkCtrl(ticker,d)
-          if(isNew):
-            logResult(ticker,d,"ctrl",diff,dseries)
+      ind = dict(series)
+      ind.update({
+        'ema1': ema1, 'ema2': ema2, 'ema3': ema3, 'ema4': ema4,
+        'ma1': ma1, 'ma2': ma2, 'ma3': ma3, 'ma4': ma4,
+      })
+      ind['w_rsi']= w_rsi= calculateRsi(wseries,14);
+      ind['w_seq']= w_seq= calculateSequential(wseries,4)
+
+      #Just today? Then we only need the latest daily values and
+      #can move on yesterday's saved state rather than start again.
+      #Not on built-up bars though, the state's for the stored ones.
+      periods = {'ema': [ema1,ema2,ema3,ema4], 'ma': [ma1,ma2,ma3,ma4], 'rsi': [14], 'seq': [4]}
+      if((BacktestDays==0) and (ShowGraphs<=0) and (CheckTimeframe==Interval) and
+         (len(dseries)>max(ema4,ma4,ema1,ma1,ema2,ma2,ema3,ma3,14)+2)):
+        streamed = getStreamedIndicators(ticker,dseries,periods)
+        ind['rsi'] = streamed['rsi14']
+        ind['seq'] = streamed['seq4']
+        for i in range(1,5):
+          ind['ma%ds'%i] = streamed['ma%d'%ind['ma%d'%i]]
+          ind['ema%ds'%i] = streamed['ema%d'%ind['ema%d'%i]]
+      else:
+        ind['rsi']  = rsi  = calculateRsi(dseries,14);
+        ind['ma1s'] = ma1s = calculateMa(dseries,ma1);
+        ind['ma2s'] = ma2s = calculateMa(dseries,ma2);
+        ind['ma3s'] = ma3s = calculateMa(dseries,ma3);
+        ind['ma4s'] = ma4s = calculateMa(dseries,ma4);
+        ind['ema1s']= ema1s= calculateEma(dseries,ema1);
+        ind['ema2s']= ema2s= calculateEma(dseries,ema2);
+        ind['ema3s']= ema3s= calculateEma(dseries,ema3);
+        ind['ema4s']= ema4s= calculateEma(dseries,ema4);
+        ind['seq']  = seq  = calculateSequential(dseries,4)
+
+      if("bets" in Checks):
+        ind['betOutcomes'] = getBetOutcomes(ticker,dseries,dateSeries,series['dateIndex'])
+
+      #Check every day in the range, or when back-testing quietly
+      #just the days the vectorised masks say something happens on.
+      if((BacktestDays>0) and (LogLevel<=0)):
+        days = getActiveBacktestDays(ticker,ind)
+      else:
+        days = range(BacktestDays,-1,-1)   #d = daysAgo
+
+      lastDay = BacktestDays+1
+      for d in days:
+        #A skipped quiet day scores zero, which beats a negative best
+        if((lastDay-d>1) and (highestDayscore<0)):
+          highestDayscore = 0
+          highestDayscoreDay = lastDay-1
+        lastDay = d
+
+        dayscore = runDayChecks(ticker,d,ind)
+        score += dayscore
 
         #High-Score list
         if(abs(dayscore)>highestDayscore):
@@ -1345,9 +3179,14 @@ def runChecks(tickers):
         if(LogLevel>0):
             print(ticker+", "+str(d)+" days ago. Score: "+str(dayscore))
 
+      if((lastDay>0) and (highestDayscore<0)):
+        highestDayscore = 0
+        highestDayscoreDay = lastDay-1
+
 
       #Back to once per ticker, Draw the graph
       if(ShowGraphs>0):
+          pyplot = getPyplot()
           ax1 = pyplot.subplot(2,1,1) # 2rows, 1cols, It's the first, Ie across top
           ax1.margins(0.,0.)
           ax1.plot(ema1s, color="#00ff00")
@@ -1400,12 +3239,344 @@ def runChecks(tickers):
       if(LogLevel>=2):
         print("%s \t price: %f \t score: %i \t high: %i \t day: %i"%(ticker,price,score,highestDayscore,highestDayscoreDay))
 
+    if(Profile):
+      recordProfile("check",ticker,time.time()-tickerStart,peakMemory()-tickerPeak)
+
   if(LogLevel>=1):
     print(tabulate(outTable,["Ticker","Price","Indic Sum","Best score", "On day"]))
   return latestPrices
 
 
 
+def runChecksInWorkers(tickers,workers):
+  """
+  Run the checks across a pool of processes, each
+  doing a run of tickers with runChecks() and sending
+  back what it found. We merge the shards back in
+  ticker order, so the alerts and results tables
+  come out the same as a single-process run.
+  The workers are forked, so they start with our
+  settings and the prices we've already fetched.
+  """
+  global alerts, resultLog, uniqcodes, betRecords
+  try:
+    context = multiprocessing.get_context("fork")
+  except ValueError:
+    print("Can't fork worker processes here, running in one.")
+    return runChecks(tickers)
+
+  shardSize = max(1,int(math.ceil(len(tickers)/float(workers*4))))
+  shards = [tickers[i:i+shardSize] for i in range(0,len(tickers),shardSize)]
+  latestPrices = {}
+  betsById = dict([(b['id'],b) for b in BetStore])
+  pool = context.Pool(workers)
+  for ret in pool.imap(runChecksShard,shards):
+    latestPrices.update(ret['lp'])
+    alerts += ret['al']
+    uniqcodes.update(ret['uc'])
+    bullishness_tops.update(ret['bt'])
+    bullreason_tops.update(ret['rt'])
+    bullishness_bots.update(ret['bb'])
+    bullreason_bots.update(ret['rb'])
+    mergeResultLog(ret['rl'])
+    betRecords += ret['br']
+    #The workers resolved their own copies of the bets
+    for rec in ret['br']:
+      if((not 'tk' in rec) and (rec['id'] in betsById)):
+        betsById[rec['id']].update(rec)
+    for key in ret['pf']:
+      stat = profileStats.setdefault(key,[0,0.0,0,0])
+      stat[0:2] = [stat[0]+ret['pf'][key][0],stat[1]+ret['pf'][key][1]]
+      stat[2] = max(stat[2],ret['pf'][key][2])
+      stat[3] += ret['pf'][key][3]
+  pool.close()
+  pool.join()
+  return latestPrices
+
+
+
+def runChecksShard(shard):
+  """
+  A worker process's part of runChecksInWorkers().
+  A worker can get several shards, so we start each
+  with empty tallies, and each fork gets its own dice
+  for the control check.
+  """
+  global alerts, uniqcodes, resultLog, betRecords, profileStats
+  global bullishness_tops, bullreason_tops, bullishness_bots, bullreason_bots
+  alerts = []
+  uniqcodes = {}
+  resultLog = newResultLog()
+  betRecords = []
+  profileStats = {}
+  bullishness_tops = {}
+  bullreason_tops = {}
+  bullishness_bots = {}
+  bullreason_bots = {}
+  random.seed()
+  latestPrices = runChecks(shard)
+  return {
+    'lp': latestPrices,
+    'al': alerts,
+    'uc': uniqcodes,
+    'bt': bullishness_tops,
+    'rt': bullreason_tops,
+    'bb': bullishness_bots,
+    'rb': bullreason_bots,
+    'rl': resultLog,
+    'br': betRecords,
+    'pf': profileStats,
+  }
+
+
+
+def runDayChecks(ticker,d,ind):
+  """
+  Run all the enabled checks for one ticker
+  on one day, d days ago, logging any results.
+  ind holds the series, indicators and periods
+  runChecks worked out. Returns the day's score.
+  """
+  global bullishness, bullreason
+  bullishness={}
+  bullreason ={}
+  dseries = ind['dseries']
+  wseries = ind['wseries']
+
+  dayscore=0
+  w = int(weeksAgo(ind,d))
+
+  #Daily-candles checks if we have enough data 
+  if(len(dseries)>0):
+    #RSI
+    if("rsi" in Checks):
+      diff,isNew = checkRsi(ind['rsi'],d,ticker,"Daily",d)
+      dayscore += diff
+      if(isNew):
+        logResult(ticker,d,"rsi",diff,dseries)
+
+    #MA and EMA crosses
+    for code,a,b,txt in getCrossChecks(ind):
+      diff,isNew = checkMaCross(ind[a+"s"],ind[b+"s"],d,ticker,txt)
+      dayscore += diff
+      if(isNew):
+        logResult(ticker,d,code,diff,dseries)
+
+    #Sequential Nines
+    if("seq" in Checks):
+      diff,isNew = checkSequential(ind['seq'],d,ticker,"d",d)
+      dayscore += diff
+      if(isNew):
+        logResult(ticker,d,"seq",diff,dseries)
+
+    #MASort -> Are the moving averages sorted into bull/bear order?
+    if("masort" in Checks):
+      diff,isNew = checkMASort(ind['ma1s'],ind['ma2s'],ind['ma3s'],ind['ma4s'],d,ticker,"MA")
+      dayscore += diff
+      if(isNew):
+        logResult(ticker,d,"masort",diff,dseries)
+
+    #MASort -> Are the moving averages sorted into bull/bear order?
+    if("emasort" in Checks):
+      diff,isNew = checkMASort(ind['ema1s'],ind['ema2s'],ind['ema3s'],ind['ema4s'],d,ticker,"EMA")
+      dayscore += diff
+      if(isNew):
+        logResult(ticker,d,"emasort",diff,dseries)
+
+   
+  #Weekly-candles checks if we have enough data, cecking weekly candles every day.
+  if(len(wseries)>0):
+    #Weekly RSI
+    if("rsi_w" in Checks):
+      diff,isNew = checkRsi(ind['w_rsi'],w,ticker,"Weekly",d)
+      dayscore += diff
+      if(isNew):
+        logResult(ticker,d,"rsi_w",diff,dseries)
+
+    #Weekly Sequential Nines
+    if("seq_w" in Checks):
+      diff,isNew = checkSequential(ind['w_seq'],w,ticker,"w",d)
+      dayscore += diff
+      if(isNew):
+        logResult(ticker,d,"seq_w",diff,dseries)
+
+  #Multi doesn't add to score, can only be checked after all tests
+  if("multi" in Checks):
+    if(dayscore>=MultiCheck):
+      logResult(ticker,d,"multi",+1,dseries)
+    if(dayscore<=-MultiCheck):
+      logResult(ticker,d,"multi",-1,dseries)
+
+  #Bet-alerting doesn't add to scores coz it's the *end* of the bet.
+  if("bets" in Checks):
+    diff,isNew = checkBetExpire(ind['betOutcomes'],dseries,d,ticker)
+    if(isNew):
+      logResult(ticker,d,"bet_%s"%("w" if diff>1 else "l"),diff,dseries)
+    
+
+  #Control randomness doesn't add to score either.
+  if("ctrl" in Checks):
+    diff,isNew = checkCtrl(ticker,d,ind.get('ctrlDraws'))
+    if(isNew):
+      logResult(ticker,d,"ctrl",diff,dseries)
+
+  return dayscore
+
+
+
+def getCrossChecks(ind):
+  """
+  The enabled MA/EMA cross checks, in the order we
+  run them, as (log code, fast, slow, label) 
+  """
+  crosses = [
+    ("max12","ma1","ma2","Short %d vs Med %d"%(ind['ma1'],ind['ma2'])),
+    ("max13","ma1","ma3","Short %d vs %d Long"%(ind['ma1'],ind['ma2'])),
+    ("max14","ma1","ma4","Short %d vs %d VLong"%(ind['ma1'],ind['ma4'])),
+    ("max23","ma2","ma3","Med %d vs %d Long"%(ind['ma2'],ind['ma3'])),
+    ("max24","ma2","ma4","Med %d vs %d VLong"%(ind['ma2'],ind['ma4'])),
+    ("max34","ma3","ma4","Long %d vs %d VLong"%(ind['ma3'],ind['ma4'])),
+    ("emax12","ema1","ema2","Exp-Short %d vs Med %d"%(ind['ema1'],ind['ema2'])),
+    ("emax13","ema1","ema3","Exp-Short %d vs Long %d"%(ind['ema1'],ind['ema3'])),
+    ("emax14","ema1","ema4","Exp-Short %d vs VLong %d"%(ind['ema1'],ind['ema4'])),
+    ("emax23","ema2","ema3","Exp-Med %d vs Long %d"%(ind['ema2'],ind['ema3'])),
+    ("emax24","ema2","ema4","Exp-Med %d vs VLong %d"%(ind['ema2'],ind['ema4'])),
+    ("emax34","ema3","ema4","Exp-Long %d vs %d Vlong"%(ind['ema3'],ind['ema4'])),
+  ]
+  ret = []
+  for code,a,b,txt in crosses:
+    #The check names are max1..4 and emax1..4, so emax14 needs emax1 and emax4
+    if((code[:-2]+code[-2] in Checks) and (code[:-2]+code[-1] in Checks)):
+      ret.append((code,a,b,txt))
+  return ret
+
+
+
+def getActiveBacktestDays(ticker,ind):
+  """
+  Work out, for the whole back-test at once, which
+  days any check could possibly fire on. Each check's
+  trigger condition is done as a numpy mask over every
+  day, so runChecks only has to run the real checks
+  (and their alerts and logging) on the days that
+  matter, and gets exactly what the day-by-day loop
+  would have. Returns days-ago, oldest first.
+  """
+  D = np.arange(BacktestDays,-1,-1)
+
+  #A -m of 0 or less has "multi" going off on quiet days too
+  if(("multi" in Checks) and (MultiCheck<=0)):
+    return D.tolist()
+  active = np.zeros(len(D),dtype=bool)
+  W = weeksAgo(ind,D)
+
+  if("rsi" in Checks):
+    active |= rsiCrossMask(ind['rsi'],D)
+  for code,a,b,txt in getCrossChecks(ind):
+    active |= maCrossDirection(ind[a+"s"],ind[b+"s"],D)!=0
+  if("seq" in Checks):
+    active |= seqNineMask(ind['seq'],D)
+  if("masort" in Checks):
+    active |= maSortDirection(ind['ma1s'],ind['ma2s'],ind['ma3s'],ind['ma4s'],D)!=0
+  if("emasort" in Checks):
+    active |= maSortDirection(ind['ema1s'],ind['ema2s'],ind['ema3s'],ind['ema4s'],D)!=0
+  if(len(ind['wseries'])>0):
+    if("rsi_w" in Checks):
+      active |= rsiCrossMask(ind['w_rsi'],W)
+    if("seq_w" in Checks):
+      active |= seqNineMask(ind['w_seq'],W)
+
+  #We already know which days the bets end on
+  if("bets" in Checks):
+    nowIdx = len(ind['dseries'])-D-1
+    active |= np.isin(nowIdx,list(ind['betOutcomes'].keys()))
+
+  #Roll the control dice in the same order the daily loop would
+  if("ctrl" in Checks):
+    ind['ctrlDraws'] = {}
+    for i in range(0,len(D)):
+      draws = [random.random()]
+      if(draws[0]<=0.99):
+        draws.append(random.random())
+      ind['ctrlDraws'][int(D[i])] = draws
+      active[i] |= max(draws)>0.99
+
+  return D[active].tolist()
+
+
+
+def backtestIndexes(series,daysAgo,minLen):
+  """
+  The index into series for each daysAgo, counting
+  from the end, and whether the checks would accept
+  it (len(series)>=daysAgo+minLen). Like the checks
+  we let index -1 wrap round to the end.
+  """
+  series = np.asarray(series,dtype=float)
+  valid = len(series) >= (daysAgo+minLen)
+  nowIdx = len(series)-daysAgo-1
+  if(len(series)==0):
+    return series, valid, np.zeros(len(daysAgo),dtype=int)
+  nowIdx = np.where(valid,nowIdx,0) % len(series)
+  return series, valid, nowIdx
+
+
+
+def rsiCrossMask(rsi,daysAgo):
+  """
+  Vectorised checkRsi: days the RSI crosses 30 or 70
+  """
+  rsi, valid, i = backtestIndexes(rsi,daysAgo,1)
+  if(len(rsi)==0):
+    return valid
+  p = (i-1) % len(rsi)
+  return valid & (((rsi[i]>30) & (rsi[p]<30)) | ((rsi[i]<70) & (rsi[p]>70)))
+
+
+
+def maCrossDirection(ma1s,ma2s,daysAgo):
+  """
+  Vectorised checkMaCross: +1 on days the first average
+  crosses above the second, -1 when it crosses below
+  """
+  ma1s, valid, i = backtestIndexes(ma1s,daysAgo,1)
+  ma2s = np.asarray(ma2s,dtype=float)
+  if(len(ma1s)==0):
+    return valid.astype(int)
+  p = (i-1) % len(ma1s)
+  up = valid & (ma1s[i]>ma2s[i]) & (ma1s[p]<=ma2s[p])
+  down = valid & (ma1s[i]<ma2s[i]) & (ma1s[p]>=ma2s[p])
+  return up.astype(int) - down.astype(int)
+
+
+
+def seqNineMask(seq,daysAgo):
+  """
+  Vectorised checkSequential: days with a 9 count
+  """
+  seq, valid, i = backtestIndexes(seq,daysAgo,0)
+  if(len(seq)==0):
+    return valid
+  return valid & (np.abs(seq[i])==9)
+
+
+
+def maSortDirection(seq1,seq2,seq3,seq4,daysAgo):
+  """
+  Vectorised checkMASort: +1 on days the averages go
+  into bullish sort order, -1 when they come out of it
+  """
+  seq1, valid, i = backtestIndexes(seq1,daysAgo,2)
+  if(len(seq1)==0):
+    return valid.astype(int)
+  seq2 = np.asarray(seq2,dtype=float)
+  seq3 = np.asarray(seq3,dtype=float)
+  seq4 = np.asarray(seq4,dtype=float)
+  isBull = (seq1>=seq2) & (seq2>=seq3) & (seq3>=seq4)
+  return (valid & isBull[i] & ~isBull[i-1]).astype(int) - (valid & ~isBull[i] & isBull[i-1]).astype(int)
+
+
+
 def checkMASort(seq1,seq2,seq3,seq4,daysAgo,ticker,t="XA"):
   """
   Check for the sort-order of the moving-averages
@@ -1453,68 +3624,86 @@ def checkMASort(seq1,seq2,seq3,seq4,daysAgo,ticker,t="XA"):
   return 0,False
 
 
-def checkBetExpire(dateSeries,priceSeries,daysAgo,ticker):
+def getBetOutcomes(ticker,priceSeries,dateSeries,dateIndex):
+  """
+  Work out once per run the bar each of this ticker's
+  bets wins or loses on. That's the first bar in its
+  window to pass the target or stop, found with one
+  vectorised search, or else the bar it times out on.
+  Returns {bar index: [(bullchange,code,message),..]}
+  with the bets in BetStore order. Only bets settled
+  on a closed bar get resolved for good, the last bar
+  might still be forming and change its mind.
+  """
+  outcomes = {}
+  if(not ticker in betsByTicker):
+    return outcomes
+  priceSeries = np.asarray(priceSeries,dtype=float)
+  hitTargets = []   #(start index, ever hit) of each bet so far
+
+  for b in betsByTicker[ticker]:
+    startBetIndex = dateIndex.get(b['ts'],-1)
+    if(startBetIndex<0):
+      continue
+    isLong = b['pr'] < b['bt']
+    window = priceSeries[startBetIndex+1:min(len(priceSeries),startBetIndex+b['dy'])]
+    if(isLong):
+      won = window>=b['bt']
+      lost = window<=b['st']
+    else:
+      won = window<=b['bt']
+      lost = window>=b['st']
+    hit = won | lost
+    hitTargets.append((startBetIndex,hit.any()))
+
+    if(hit.any()):
+      first = int(np.argmax(hit))
+      i = startBetIndex+1+first
+      if(i<len(priceSeries)-1):
+        resolveBet(b,'W' if won[first] else 'L',float(priceSeries[i]),dateSeries[i])
+      if(won[first]):
+        outcome = (+1,"bet_w","%s Win: %0.2f beats target"%("Long" if isLong else "Short",priceSeries[i]))
+      else:
+        outcome = (-1,"bet_w","%s Loss: Stop Reached"%("Long" if isLong else "Short"))
+      outcomes.setdefault(i,[]).append(outcome)
+      continue
+
+    #Timed out. A hit on any earlier bet that's started by 
+    #then stops it counting, as it always has.
+    nowIdx = startBetIndex+b['dy']
+    if((nowIdx<startBetIndex) or (nowIdx>=len(priceSeries))):
+      continue
+    if(any([hasHit and (start<=nowIdx) for start,hasHit in hitTargets])):
+      continue
+    if(nowIdx<len(priceSeries)-1):
+      resolveBet(b,'E',float(priceSeries[nowIdx]),dateSeries[nowIdx])
+    if(isLong):
+      if(priceSeries[nowIdx]>=b['pr']):
+        outcome = (+1,"bet_w","Long Win: Timed Out In Profit")
+      else:
+        outcome = (-1,"bet_l","Long Loss: Timed Out In Loss")
+    else:
+      if(priceSeries[nowIdx]>=b['pr']):
+        outcome = (-1,"bet_w","Short Loss: Timed Out In Loss")
+      else:
+        outcome = (+1,"bet_l","Short Win: Timed Out In Profit")
+    outcomes.setdefault(nowIdx,[]).append(outcome)
+
+  return outcomes
+
+
+
+def checkBetExpire(outcomes,priceSeries,daysAgo,ticker):
   """
   Check if this ticker has just won or lost any of 
-  the bets that have been placed.
+  the bets that have been placed, by looking the
+  day up in the ticker's getBetOutcomes().
   """
   retScore = 0
   nowIdx = len(priceSeries) - daysAgo-1
-
-  hitTarget=False
-  for b in BetStore:                                              ##Check each bet
-    if(b['tk']==ticker):                                          ##Has the right ticker
-      startBetIndex = getIndexInDateSeries(b['ts'],dateSeries)
-      if((startBetIndex>=0)and(startBetIndex <= nowIdx)):         ##Passed the start-date
-        for i in range(startBetIndex+1,min(len(priceSeries),startBetIndex+b['dy'])):
-          if(b['pr'] < b['bt']):   ##Long bet
-            if(priceSeries[i]>=b['bt']):
-              #Bet hit target on day i
-              if(nowIdx==i):
-                doAlert(+1,ticker,"bet_w","Long Win: %0.2f beats target"%(priceSeries[i]),daysAgo)
-                retScore+=1;
-              hitTarget=True
-              break;
-            if(priceSeries[i]<=b['st']):
-              #Stop hit on day i
-              if(nowIdx==i):
-                doAlert(-1,ticker,"bet_w","Long Loss: Stop Reached",daysAgo)
-                retScore-=1;
-              hitTarget=True
-              break;
-
-          else:                    ##Short bet
-            if(priceSeries[i]<=b['bt']):
-              #Bet hit target on day i
-              if(nowIdx==i):
-                doAlert(+1,ticker,"bet_w","Short Win: %0.2f beats target"%(priceSeries[i]),daysAgo)
-                retScore+=1;
-              hitTarget=True
-              break;
-            if(priceSeries[i]>=b['st']):
-              #Stop hit on day i
-              if(nowIdx==i):
-                doAlert(-1,ticker,"bet_w","Short Loss: Stop Reached",daysAgo)
-                retScore-=1;
-              hitTarget=True
-              break;
-
-        ##Bet timed out?
-        if((not hitTarget) and (nowIdx==startBetIndex+b['dy'])):
-          if(b['pr'] < b['bt']):   ##Long bet
-            if(priceSeries[nowIdx]>=b['pr']):
-              doAlert(+1,ticker,"bet_w","Long Win: Timed Out In Profit",daysAgo)
-              retScore+=1;
-            else:
-              doAlert(-1,ticker,"bet_l","Long Loss: Timed Out In Loss",daysAgo)
-              retScore-=1;
-          else:                    ##Short bet
-            if(priceSeries[nowIdx]>=b['pr']):
-              doAlert(-1,ticker,"bet_w","Short Loss: Timed Out In Loss",daysAgo)
-              retScore-=1;
-            else:
-              doAlert(+1,ticker,"bet_l","Short Win: Timed Out In Profit",daysAgo)
-              retScore+=1;
+  for bullchange,code,message in outcomes.get(nowIdx,[]):
+    doAlert(bullchange,ticker,code,message,daysAgo)
+    retScore += bullchange
 
   if(retScore==0):
     return 0,False
@@ -1524,15 +3713,22 @@ def checkBetExpire(dateSeries,priceSeries,daysAgo,ticker):
 
 
 
-def checkCtrl(ticker,daysAgo):
+def checkCtrl(ticker,daysAgo,draws=None):
   """
   Check for just a random 1% chance, to use as a control
-  to compare other checks against
+  to compare other checks against. The back-test engine
+  rolls the dice up front and passes them in as draws.
   """
-  if(random.random() > 0.99):
+  if(draws==None):
+    draws = [random.random()]
+    if(draws[0] <= 0.99):
+      draws.append(random.random())
+  else:
+    draws = draws[daysAgo]
+  if(draws[0] > 0.99):
     x=doAlert(+1,ticker,"rndbull","Random Bull",daysAgo)
     return +1,x
-  if(random.random() > 0.99):
+  if(draws[1] > 0.99):
     x=doAlert(-1,ticker,"rndbear","Random Bear",daysAgo)
     return -1,x
   return 0,False
@@ -1606,6 +3802,38 @@ def checkRsi(rsi,daysAgo,ticker,t="Daily",realDaysAgo=-1):
 
 
 
+def newResultLog():
+  """
+  An empty results log. Each signal is one entry in the
+  arrays: ticker id 't', bar index 'b' into that ticker's
+  prices, direction 'p' and indicator code id 'c'. The
+  prices are shared, one array per ticker id in 's', so
+  each signal costs a few bytes however long we watch it.
+  """
+  return {
+    'cn': [], 'ci': {},
+    'tn': [], 'ti': {}, 's': [],
+    't': array.array('i'),
+    'b': array.array('i'),
+    'p': array.array('b'),
+    'c': array.array('h'),
+  }
+
+
+
+def resultLogCode(rl,indicode):
+  """
+  The id of an indicator code in a results log,
+  adding it if it's new. Ids go in the order we
+  first saw them, which is the order we show them.
+  """
+  if(not indicode in rl['ci']):
+    rl['ci'][indicode] = len(rl['cn'])
+    rl['cn'].append(indicode)
+  return rl['ci'][indicode]
+
+
+
 def logResult(ticker, daysAgo, indicode, prediction, prices):
   """
   Log a result to the global stats-tracker.
@@ -1626,127 +3854,540 @@ def logResult(ticker, daysAgo, indicode, prediction, prices):
   if(daysAgo>=len(prices)):
     return
 
-  if(not indicode in resultLog):
-    resultLog[indicode] = {}
-
-  if(not ticker in resultLog[indicode]):
-    resultLog[indicode][ticker] = {}
-    resultLog[indicode][ticker][-1] = []
-    resultLog[indicode][ticker][+1] = []
-  
+  codeId = resultLogCode(resultLog,indicode)
 
   nowIdx = len(prices) - daysAgo-1
   startPrice = prices[nowIdx];
   if(startPrice<=0):
     print("Ticker %s has a price of zero %d days ago (%d index into list %d long). Weird!?"%(ticker,daysAgo,nowIdx,len(prices)))
     return
-  keepTill = nowIdx+ANALYSISPERIOD+1
-  if(keepTill>len(prices)):
-    keepTill = len(prices)
-  gains = []
-  for newprice in prices[nowIdx:keepTill]:
-    gains.append(((newprice-startPrice)/startPrice))
-  logEntry = {
-    'o': startPrice,
-    'p': prediction,
-    'd': daysAgo,
-    's': prices[nowIdx:nowIdx+keepTill],
-    'g': gains
-  }
-  resultLog[indicode][ticker][prediction].append(logEntry)
+
+  #Every check on a ticker logs against the same series, so we keep it once
+  tickerId = resultLog['ti'].get(ticker)
+  if((tickerId is None) or (resultLog['s'][tickerId] is not prices)):
+    tickerId = len(resultLog['tn'])
+    resultLog['ti'][ticker] = tickerId
+    resultLog['tn'].append(ticker)
+    resultLog['s'].append(prices)
+
+  resultLog['t'].append(tickerId)
+  resultLog['b'].append(nowIdx)
+  resultLog['p'].append(prediction)
+  resultLog['c'].append(codeId)
+
+
+
+def mergeResultLog(rl):
+  """
+  Add the entries of another results log (from
+  a worker process) on to the end of ours.
+  """
+  global resultLog
+  codeMap = [resultLogCode(resultLog,indicode) for indicode in rl['cn']]
+  offset = len(resultLog['tn'])
+  for tickerId in range(0,len(rl['tn'])):
+    resultLog['ti'][rl['tn'][tickerId]] = tickerId+offset
+  resultLog['tn'] += rl['tn']
+  resultLog['s'] += rl['s']
+  resultLog['t'].extend(array.array('i',[tickerId+offset for tickerId in rl['t']]))
+  resultLog['b'].extend(rl['b'])
+  resultLog['p'].extend(rl['p'])
+  resultLog['c'].extend(array.array('h',[codeMap[codeId] for codeId in rl['c']]))
 
 
    
 
 
+def forwardGains(prices,nowIdxs):
+  """
+  The gain from each start bar in nowIdxs over
+  the next ANALYSISPERIOD bars, one row per start,
+  NaN past the end of the prices (or for a start
+  price that's zero or less, which logResult skips)
+  """
+  prices = np.asarray(prices,dtype=float)
+  nowIdxs = np.asarray(nowIdxs,dtype=int)
+  idx = nowIdxs[:,None] + np.arange(ANALYSISPERIOD+1)[None,:]
+  valid = idx < len(prices)
+  startPrice = prices[nowIdxs][:,None]
+  window = prices[np.minimum(idx,len(prices)-1)]
+  with np.errstate(divide='ignore',invalid='ignore'):
+    return np.where(valid & (startPrice>0), (window-startPrice)/startPrice, np.nan)
+
+
+
+def gainStats(gains,prediction):
+  """
+  Sum up rows of forwardGains like showResultLog does:
+  total gain and count at each bar, and how many had
+  by then hit TriggerPercent in the predicted direction.
+  """
+  valid = ~np.isnan(gains)
+  if(prediction>0):
+    hit = gains > TriggerPercent
+  else:
+    hit = gains < -TriggerPercent
+  hit = np.logical_or.accumulate(hit,axis=1) & valid
+  return [np.where(valid,gains,0).sum(axis=0), valid.sum(axis=0), hit.sum(axis=0)]
+
+
+
 def showResultLog():
   """
   Summarize the results log in tables.
+  The forward gains are worked out a ticker
+  at a time straight from its price array.
   """
   global resultLog, ANALYSISPERIOD, TriggerPercent
-  if(len(resultLog)<=0):
+  if(len(resultLog['cn'])<=0):
     return
 
+  tickerIds = np.array(resultLog['t'],dtype=int)
+  bars = np.array(resultLog['b'],dtype=int)
+  predictions = np.array(resultLog['p'],dtype=int)
+  codeIds = np.array(resultLog['c'],dtype=int)
+  periods = [i for i in TimeCheck_Periods if i<=ANALYSISPERIOD]
+
   #We build a table showing the average gain found after indicator triggering
   avgGainDisplay = []
 
   #We build a table showing how many days until the price jumps/drops by X percent following a signal
   daysTillXPercentDisplay = []
 
+  #And one showing how spread out the gains are
+  percentileDisplay = []
+
   #Display Bull Indicators, then Bearish
   for prediction in ([+1,-1]):
     bullbear = "Bull" if (prediction>=0) else "Bear"
     #For every indicator's code
-    for indicode in resultLog:
-      avgGains = [0] * (ANALYSISPERIOD+1)
-      avgCnts  = [0] * (ANALYSISPERIOD+1)
-      sumHitX  = [0] * (ANALYSISPERIOD+1)
+    for codeId in range(0,len(resultLog['cn'])):
+      indicode = resultLog['cn'][codeId]
+      sums   = np.zeros(ANALYSISPERIOD+1)
+      avgCnts = np.zeros(ANALYSISPERIOD+1,dtype=int)
+      sumHitX = np.zeros(ANALYSISPERIOD+1,dtype=int)
+      periodGains = [np.zeros((0,len(periods)))]
 
       #For every ticker it was applied to
-      for ticker in resultLog[indicode]:
-        if(prediction in resultLog[indicode][ticker]):
-          #For every time that was trggered and logged...
-          for logEntry in resultLog[indicode][ticker][prediction]:
-            fmtStg ="%s %s %s:\t %d %0.2f -> ";
-            fmtPrm =[indicode,ticker,bullbear,logEntry['d'], logEntry['o']]
-            startPrice = logEntry['o']
+      entries = np.nonzero((codeIds==codeId) & (predictions==prediction))[0]
+      for tickerId in np.unique(tickerIds[entries]):
+        prices = resultLog['s'][tickerId]
+        starts = bars[entries[tickerIds[entries]==tickerId]]
+        gains = forwardGains(prices,starts)
+        tickerSums, tickerCnts, tickerHits = gainStats(gains,prediction)
+        sums += tickerSums
+        avgCnts += tickerCnts
+        sumHitX += tickerHits
+        periodGains.append(gains[:,periods])
 
-            #Work out the average gains (Well, total for now, we'll divide shortly)
-            hasHitX=False
+        if(LogLevel>0):
+          for j in range(0,len(starts)):
+            fmtStg ="%s %s %s:\t %d %0.2f -> ";
+            fmtPrm =[indicode,resultLog['tn'][tickerId],bullbear,len(prices)-starts[j]-1,prices[starts[j]]]
             for i in range(0,ANALYSISPERIOD+1):
-              if(i < len(logEntry['g'])):
-                avgGains[i]+=logEntry['g'][i]
-                avgCnts[i]+=1
-                if(i in TimeCheck_Periods):
-                  fmtStg+="\t%0.2f(%0.2f)"
-                  fmtPrm.append(logEntry['s'][i])
-                  fmtPrm.append(logEntry['g'][i])
-                if(logEntry['p']>0):
-                  if((logEntry['g'][i]>TriggerPercent)or(hasHitX)):
-                    hasHitX=True
-                    sumHitX[i]+=1
-                else:
-                  if((logEntry['g'][i]<-TriggerPercent)or(hasHitX)):
-                    hasHitX=True
-                    sumHitX[i]+=1
-
-            if(LogLevel>0):
-              print(fmtStg % tuple(fmtPrm))
+              if((i in TimeCheck_Periods) and (starts[j]+i < len(prices))):
+                fmtStg+="\t%0.2f(%0.2f)"
+                fmtPrm.append(prices[starts[j]+i])
+                fmtPrm.append(gains[j][i])
+            print(fmtStg % tuple(fmtPrm))
 
       #Divide the sums of gains to get averages..
-      for i in range(0,len(avgGains)):
-        if(avgCnts[i]>0): 
-          avgGains[i] /= avgCnts[i]
+      avgGains = sums/np.maximum(avgCnts,1)
+      periodGains = np.concatenate(periodGains)
 
       #Build ouput rows for this indicator's Average Gain
       newRow = [indicode,bullbear]
-      for i in TimeCheck_Periods:
-        if(i <= len(avgGains)):
-          newRow.append("%+0.1f %% / %d" % (avgGains[i]*100,avgCnts[i]))
+      for i in periods:
+        newRow.append("%+0.1f %% / %d" % (avgGains[i]*100,avgCnts[i]))
       avgGainDisplay.append(newRow)
 
       #Build output rows for this indicator's NumHitX
       newRow = [indicode,bullbear]
-      for i in TimeCheck_Periods:
-        if(i <= len(sumHitX)):
-          newRow.append("%d / %d" % (sumHitX[i],avgCnts[i]))
+      for i in periods:
+        newRow.append("%d / %d" % (sumHitX[i],avgCnts[i]))
       daysTillXPercentDisplay.append(newRow)
 
+      #And the quartiles of the gains
+      newRow = [indicode,bullbear]
+      for j in range(0,len(periods)):
+        column = periodGains[:,j]
+        column = column[~np.isnan(column)]*100
+        if(len(column)>0):
+          newRow.append("%+0.1f / %+0.1f / %+0.1f" % tuple(np.percentile(column,[25,50,75])))
+        else:
+          newRow.append("-")
+      percentileDisplay.append(newRow)
+
   print("\nAverage Gain After Signal:")   
   headers = ["Signal","Direction"]
-  for i in TimeCheck_Periods:
+  for i in periods:
     headers.append(str(i)+" Bar") 
   print(tabulate(avgGainDisplay,headers))
  
 
   print("\nNumber that Hit +/-"+str(TriggerPercent*100)+"% gain/loss in bull/bear by:")   
-  headers = ["Signal","Direction"]
-  for i in TimeCheck_Periods:
-    headers.append(str(i)+" Bar") 
   print(tabulate(daysTillXPercentDisplay,headers))
 
 
+  print("\nGain % After Signal, 25th / 50th / 75th percentile:")   
+  print(tabulate(percentileDisplay,headers))
+
+
  
+def parseSweepSpec(spec):
+  """
+  Turn "ema1=10:30:5,ma4=200" into a list of
+  (name,[values]), where start:stop:step includes
+  the stop, and a plain number is just that one.
+  """
+  ranges = []
+  for part in spec.replace(" ","").split(","):
+    name, rng = part.split("=")
+    bits = [int(b) for b in rng.split(":")]
+    if(len(bits)==1):
+      bits = [bits[0],bits[0]]
+    step = bits[2] if len(bits)>2 else 1
+    ranges.append((name,list(range(bits[0],bits[1]+1,step))))
+  return ranges
+
+
+
+def runSweep(tickers,spec):
+  """
+  Back-test every combination of the MA/EMA periods
+  given in spec, for the enabled cross and sort checks,
+  and print them ranked by how well they did.
+  Each ticker's series is loaded once. Averages are 
+  worked out once per period (MAs straight from a
+  cumulative sum) and each pair's crosses and their
+  forward gains once per pair of periods, so most
+  combinations are just adding up cached numbers.
+  """
+  ranges = parseSweepSpec(spec)
+  names = [r[0] for r in ranges]
+  combos = list(itertools.product(*[r[1] for r in ranges]))
+  print("Sweeping %d combinations of %s over %d tickers" % (len(combos),", ".join(names),len(tickers)))
+  totals = {}
+
+  for ticker in tickers:
+    prices = priceCache[ticker] if (ticker in priceCache) else getPrices(ticker)
+    dseries = np.asarray(getSeries(checkPrices(prices),"c")['dseries'],dtype=float)
+    if(len(dseries)<=6):
+      continue
+    days = BacktestDays if (BacktestDays>0) else len(dseries)-1
+    D = np.arange(5,min(days,len(dseries)-1)+1)
+    gains = forwardGains(dseries,len(dseries)-D-1)
+    cumsum = np.concatenate(([0.],np.cumsum(dseries)))
+    averages = {}
+    pairs = {}
+
+    base = getTickerPeriods(ticker)
+    for combo in combos:
+      ind = dict(base)
+      ind.update(zip(names,combo))
+      for code,a,b,txt in getCrossChecks(ind):
+        kind = a[:-1]
+        pair = (kind,ind[a],ind[b])
+        if(not pair in pairs):
+          direction = maCrossDirection(sweepAverage(averages,dseries,cumsum,kind,ind[a]),
+                                       sweepAverage(averages,dseries,cumsum,kind,ind[b]),D)
+          pairs[pair] = sweepStats(gains,direction)
+        addSweepStats(totals,combo,code,pairs[pair])
+      for kind,code in (("ma","masort"),("ema","emasort")):
+        if(code in Checks):
+          direction = maSortDirection(*[sweepAverage(averages,dseries,cumsum,kind,ind[kind+str(i)]) for i in range(1,5)]+[D])
+          addSweepStats(totals,combo,code,sweepStats(gains,direction))
+
+  #Rank by the average gain in the signal's direction
+  rows = []
+  for (combo,code,prediction) in totals:
+    sums, counts, hits = totals[(combo,code,prediction)]
+    if(counts[SweepRankPeriod]<SweepMinCount):
+      continue
+    avgs = sums/np.maximum(counts,1)
+    row = [" ".join("%s=%d"%(names[i],combo[i]) for i in range(0,len(names))), code, "Bull" if prediction>0 else "Bear"]
+    for i in TimeCheck_Periods:
+      if(i <= ANALYSISPERIOD):
+        row.append("%+0.1f %% %d/%d" % (avgs[i]*100,hits[i],counts[i]))
+    rows.append((prediction*avgs[SweepRankPeriod],row))
+  rows.sort(key=operator.itemgetter(0),reverse=True)
+
+  print("\nBest by average gain after %d bars (avg, number that hit +/-%s%%/count):" % (SweepRankPeriod,str(TriggerPercent*100)))
+  headers = ["Params","Signal","Direction"]
+  for i in TimeCheck_Periods:
+    headers.append(str(i)+" Bar")
+  print(tabulate([r[1] for r in rows[0:SweepTop]],headers))
+
+
+
+def sweepAverage(averages,dseries,cumsum,kind,n):
+  """
+  A ticker's n-period MA or EMA for runSweep(), kept
+  in averages so each period's only worked out once.
+  MAs come straight from cumsum, the cumulative sum
+  of dseries with a 0 on the front.
+  """
+  if(not (kind,n) in averages):
+    if(kind=="ema"):
+      averages[(kind,n)] = np.asarray(calculateEma(dseries,n),dtype=float)
+    else:
+      m = min(n,len(dseries))
+      ma = np.full(len(dseries),np.nan)
+      ma[m-1:] = (cumsum[m:]-cumsum[:-m])/m
+      averages[(kind,n)] = ma
+  return averages[(kind,n)]
+
+
+
+def sweepStats(gains,direction):
+  """
+  gainStats() for the bull and the bear signals
+  in direction, one per forwardGains row.
+  """
+  return [gainStats(gains[direction==p],p) for p in (+1,-1)]
+
+
+
+def addSweepStats(totals,combo,code,stats):
+  """
+  Add a ticker's sweepStats() for a combination
+  and check to runSweep()'s totals.
+  """
+  for p in (0,1):
+    key = (combo,code,(+1,-1)[p])
+    if(not key in totals):
+      totals[key] = stats[p]
+    else:
+      totals[key] = [totals[key][i]+stats[p][i] for i in range(0,3)]
+
+
+
+def parseBenchSizes(spec):
+  """
+  "100x5,1000x30" -> [(100,5),(1000,30)], tickers by years
+  """
+  sizes = []
+  for part in spec.replace(" ","").split(","):
+    count, years = part.lower().split("x")
+    sizes.append((int(count),float(years)))
+  return sizes
+
+
+
+def makeBenchHistory(count,years,seed):
+  """
+  Fill history/ with count made-up tickers, each with
+  years of daily bars up to today: a random walk with
+  the highs, lows and volumes roughly where they'd be.
+  """
+  rng = np.random.default_rng(seed)
+  bars = max(int(years*365),1)
+  today = int(time.time())//86400
+  t = np.arange(today-bars+1,today+1)*86400.0
+  made = []
+  for i in range(0,count):
+    ticker = "SYN%05d.BINANCE" % i
+    close = 100*np.exp(np.cumsum(rng.normal(0,0.02,bars)))
+    opn = np.concatenate(([100.0],close[:-1]))
+    spread = 1+np.abs(rng.normal(0,0.01,bars))
+    prices = np.array([t,opn,np.maximum(opn,close)*spread,np.minimum(opn,close)/spread,close,rng.lognormal(12,1,bars)])
+    savePriceData(ticker,prices)
+    made.append(ticker)
+  return made
+
+
+
+def runBench(sizes,depths):
+  """
+  Time each phase of a run, offline, over made-up
+  histories of each size and back-tested to each
+  depth: loading the prices, getSeries(), the
+  calculate*() indicators, runChecks() and then
+  showResultLog(). Prints a table and saves the lot
+  in BENCHFILE.
+  """
+  global BacktestDays, LogLevel, Offline, tickers
+  contextlib = lazyImport("contextlib")
+  #Get the imports out of the way, they're not what we're timing
+  lazyImport("pandas")
+  lazyImport("tabulate")
+  os.makedirs(BENCHDIR+"/history",exist_ok=True)
+  os.chdir(BENCHDIR)
+  Offline = True
+  LogLevel = 0
+  phases = ["getPrices","getSeries","calculate","runChecks","showResultLog"]
+  runs = []
+  rows = []
+
+  for count,years in sizes:
+    for fn in os.listdir("history"):
+      os.remove("history/"+fn)
+    t = time.time()
+    tickers = makeBenchHistory(count,years,BenchSeed)
+    made = time.time()-t
+
+    for depth in depths:
+      resetRunState()
+      BacktestDays = depth
+      times = {}
+      t = time.time()
+      fetchAllPrices(tickers)
+      times['getPrices'] = time.time()-t
+
+      t = time.time()
+      allSeries = [getSeries(priceCache[ticker],"c") for ticker in tickers]
+      times['getSeries'] = time.time()-t
+
+      t = time.time()
+      for ticker,series in zip(tickers,allSeries):
+        periods = getTickerPeriods(ticker)
+        dseries = series['dseries']
+        calculateRsi(dseries,14)
+        calculateSequential(dseries,4)
+        for i in range(1,5):
+          calculateMa(dseries,periods['ma%d'%i])
+          calculateEma(dseries,periods['ema%d'%i])
+      times['calculate'] = time.time()-t
+
+      with open(os.devnull,"w") as devnull:
+        with contextlib.redirect_stdout(devnull):
+          t = time.time()
+          runChecks(tickers)
+          times['runChecks'] = time.time()-t
+          t = time.time()
+          showResultLog()
+          times['showResultLog'] = time.time()-t
+
+      runs.append({'tickers':count, 'years':years, 'depth':depth, 'generate':made, 'phases':times})
+      rows.append([count,years,depth]+["%0.3f"%times[p] for p in phases]+["%0.3f"%sum(times.values())])
+      print("%d tickers x %g years, depth %d: %0.2fs" % (count,years,depth,sum(times.values())))
+
+  writeFile(BENCHFILE,json.dumps({
+    'when': datetime.now().isoformat(),
+    'python': sys.version.split()[0],
+    'numpy': np.__version__,
+    'runs': runs,
+  },indent=1))
+  print(tabulate(rows,["Tickers","Years","Depth"]+phases+["Total"]))
+  print("Saved in %s/%s" % (BENCHDIR,BENCHFILE))
+
+
+
+def runOnce(report=True,onlyIfNew=False):
+  """
+  One go of the agent: update prices, then run the
+  checks, save the bets, and if report send out the
+  alerts. With onlyIfNew we stop after the prices if
+  there weren't any to fetch. With --sweep we rank
+  the periods instead of checking. Returns whether
+  the checks ran.
+  """
+  global webCacheWritten
+  fetched = profiled("fetchAllPrices",fetchAllPrices,tickers)
+  markStartup("prices")
+  if(SweepSpec!=None):
+    profiled("runSweep",runSweep,tickers,SweepSpec)
+    return False
+  if(onlyIfNew and (fetched==0)):
+    return False
+  if((Workers>1) and (PlaceBetArgs==None)):
+    latestPrices = profiled("runChecks",runChecksInWorkers,tickers,Workers)
+  else:
+    latestPrices = profiled("runChecks",runChecks,tickers)
+
+  profiled("saveBets",saveBets)
+  if(webCacheWritten>0):
+    profiled("webCacheGc",webCacheGc)
+    webCacheWritten = 0
+
+  #Send out the accumulated alerts.
+  if(report):
+    profiled("emailAlerts",emailAlerts)
+
+  #Re-save the Libre-Office import...
+  profiled("updateTheCsv",updateTheCsv,
+               OUT_CSV_FILE,
+               latestPrices,
+               OUT_HTML_FILE)
+
+  #If there was a backtest-result, show that.
+  profiled("showResultLog",showResultLog)
+  return True
+
+
+
+def lastReportTime(now):
+  """
+  The latest of DaemonReportTimes that's been and gone
+  """
+  times = []
+  for day in (now-timedelta(days=1),now):
+    for hm in DaemonReportTimes:
+      h, m = hm.split(":")
+      times.append(datetime(day.year,day.month,day.day,int(h),int(m)))
+  return max([t for t in times if t<=now])
+
+
+
+def watchedFileTimes():
+  """
+  When tickers.txt and the bets were last changed
+  """
+  return dict([(fn,os.path.getmtime(fn) if os.path.isfile(fn) else None) for fn in (TickersName,BETJOURNAL,"bets.json")])
+
+
+
+def runDaemon():
+  """
+  Keep running runOnce() every DAEMONTICK seconds,
+  only bothering with the checks if there were new
+  prices, tickers or bets, and sending the alerts at
+  the DaemonReportTimes. Everything loaded stays in
+  memory between goes. A go that crashes gets its
+  traceback printed and we carry on. CTRL-C stops.
+  """
+  global tickers, tickerParams, htmlCache
+  print("Running as a daemon, every %ds, reporting at %s" % (DAEMONTICK,", ".join(DaemonReportTimes)))
+  seen = watchedFileTimes()
+  lastReport = lastReportTime(datetime.now())
+  first = True
+  while(True):
+    try:
+      changed = watchedFileTimes()
+      if(changed[TickersName]!=seen[TickersName]):
+        print("Reloading "+TickersName)
+        tickers = None
+        tickerParams = {}
+        readTickers()
+      if((changed[BETJOURNAL]!=seen[BETJOURNAL]) or (changed["bets.json"]!=seen["bets.json"])):
+        print("Reloading the bets")
+        readBets()
+
+      reportTime = lastReportTime(datetime.now())
+      report = (reportTime>lastReport)
+      resetRunState(keepCaches=True)
+      now = time.time()
+      htmlCache = dict([(url,htmlCache[url]) for url in htmlCache if now-htmlCache[url][0] < webCacheTtl(url)])
+      force = first or report or (changed!=seen)
+      first = False
+      if(report):
+        lastReport = reportTime
+      ran = runOnce(report,onlyIfNew=not force)
+      if((LogLevel>=1) and ran):
+        print("Checked %d tickers at %s%s" % (len(tickers),datetime.now().strftime("%H:%M"),", reported" if report else ""))
+    except KeyboardInterrupt:
+      return
+    except Exception:
+      traceback.print_exc()
+    finally:
+      seen = watchedFileTimes()    #Our own bet updates don't count
+    try:
+      time.sleep(DAEMONTICK)
+    except KeyboardInterrupt:
+      return
+
+
+
 def emailAlerts():
   """
   Send an email with the alerts from today.
@@ -1782,6 +4423,7 @@ def emailAlerts():
   if(Send_Email):
     try:
         print("Sending Email To "+str(MAIL_SMTPHOST)+":"+str(MAIL_SMTPPORT)+"->"+str(MAIL_USER));
+        smtplib = lazyImport("smtplib")
         server = smtplib.SMTP_SSL(MAIL_SMTPHOST, MAIL_SMTPPORT)
         server.ehlo()
         server.login(MAIL_USER, MAIL_PASSWORD)
@@ -1862,7 +4504,11 @@ def placeBet(ticker,prices,params_string):
   }
   if(comment!=None):
     newBet['cm'] = comment
+  newBet['id'] = betIndex['n']
+  betIndex['n'] += 1
+  betRecords.append(dict(newBet))
   BetStore.append(newBet)
+  betsByTicker.setdefault(ticker,[]).append(newBet)
   print("Placing Bet: %s, %s\n    ->From %0.2f To %0.2f with a stop of %0.2f or %d days (Conf: %0.2f)\n "%(nowkey,ticker,price,bet,stop,days,confidence))
 
 
@@ -1870,10 +4516,11 @@ def placeBet(ticker,prices,params_string):
 ########################
 # Exectuion start
 ########################
+resultLog = newResultLog()
 
 #Process CLI Args
 try:
-  opts, args = getopt.getopt(sys.argv[1:],"Hhl:e:b:s:g:c:t:p:m:B:",["log=","email=","backtest=","score=","graph=","checks=","ticker=","percent=","multi=","bet=","fetch-history"])
+  opts, args = getopt.getopt(sys.argv[1:],"Hhl:e:b:s:g:c:t:p:m:B:w:",["log=","email=","backtest=","score=","graph=","checks=","ticker=","percent=","multi=","bet=","workers=","sweep=","profile-startup","cache-stats","cache-gc","fetch-history","migrate-history","record","replay-server=","replay-latency=","replay-errors=","replay-429=","base-url=","offline","bench=","bench-depths=","profile","profile-dump=","daemon","report-at=","interval=","timeframe="])
 except getopt.GetoptError:
   printHelp()
   sys.exit(2)
@@ -1888,6 +4535,12 @@ for opt,arg in opts:
   elif opt in ("-H","--fetch-history"):
     FetchHistory = True
 
+  #Convert old JSON history into columns.
+  elif(opt == "--migrate-history"):
+    os.chdir(MyDirectory)
+    migrateHistory()
+    sys.exit()
+
   #List Checks
   elif(opt == "--list-checks"):
     print("NAME\tALERTS WHEN")
@@ -1942,9 +4595,100 @@ for opt,arg in opts:
   elif opt in ("-B","--bet"):
     PlaceBetArgs = arg;
 
+  #Worker processes for the checks
+  elif opt in ("-w","--workers"):
+    Workers = int(arg)
+
+  #Parameter sweep instead of the usual run
+  elif(opt == "--sweep"):
+    SweepSpec = arg
+
+  #How long does it take to get going?
+  elif(opt == "--profile-startup"):
+    ProfileStartup = True
+
+  #Where does the time go?
+  elif(opt == "--profile"):
+    Profile = True
+  elif(opt == "--profile-dump"):
+    Profile = True
+    ProfileDump = os.path.abspath(arg)
+
+  #Web cache housekeeping
+  elif(opt == "--cache-stats"):
+    os.chdir(MyDirectory)
+    showWebCacheStats()
+    sys.exit()
+  elif(opt == "--cache-gc"):
+    os.chdir(MyDirectory)
+    removed, freed = webCacheGc()
+    print("Removed %d pages, %0.1f MB" % (removed,freed/1048576.0))
+    sys.exit()
+
+  #Record API responses, or serve them back
+  elif(opt == "--record"):
+    RecordFixtures = True
+  elif(opt == "--replay-server"):
+    ReplayPort = int(arg)
+  elif(opt == "--replay-latency"):
+    ReplayLatency = float(arg)
+  elif(opt == "--replay-errors"):
+    ReplayErrorRate = float(arg)
+  elif(opt == "--replay-429"):
+    ReplayRateLimitRate = float(arg)
+  elif(opt == "--base-url"):
+    setBaseUrl(arg)
+
+  #Keep running
+  elif(opt == "--daemon"):
+    Daemon = True
+  elif(opt == "--report-at"):
+    DaemonReportTimes = arg.replace(" ","").split(",")
+
+  #Don't fetch anything
+  elif(opt == "--offline"):
+    Offline = True
+
+  #Benchmark on made-up histories
+  elif(opt == "--bench"):
+    BenchSizes = parseBenchSizes(arg)
+  elif(opt == "--bench-depths"):
+    BenchDepths = [int(d) for d in arg.split(",")]
+
+  #Intraday bars
+  elif(opt == "--interval"):
+    Interval = arg
+  elif(opt == "--timeframe"):
+    CheckTimeframe = arg
+
+if(Daemon and (SweepSpec!=None)):
+  print("--sweep is a one-off, it can't run with --daemon")
+  sys.exit(2)
+if(CheckTimeframe==None):
+  CheckTimeframe = Interval
+if((not Interval in INTERVALSECONDS) or (not CheckTimeframe in INTERVALSECONDS) or
+   (INTERVALSECONDS[CheckTimeframe]%INTERVALSECONDS[Interval]!=0)):
+  print("--interval and --timeframe need to be one of "+",".join(INTERVALSECONDS)+
+        ", and the timeframe a whole number of intervals")
+  sys.exit(2)
+
+if(ReplayPort!=None):
+  os.chdir(MyDirectory)
+  runReplayServer(ReplayPort)
+  sys.exit()
+if(BenchSizes!=None):
+  os.chdir(MyDirectory)
+  runBench(BenchSizes,BenchDepths)
+  sys.exit()
 
 
 
+markStartup("settings and CLI")
+if(ProfileStartup):
+  atexit.register(showStartupProfile)
+if(Profile):
+  startProfile()
+
 #Print a header to the log.
 if(LogLevel>=1):
   now = date.today()
@@ -1953,23 +4697,12 @@ if(LogLevel>=1):
 
 #Init
 os.chdir(MyDirectory) #Start in the right directory
-readTickers()
-readBets()
-
-#Update prices and run checks...
-latestPrices = runChecks(tickers)
-
-saveBets()
-
-#Send out the accumulated alerts.
-emailAlerts()
-
-#Re-save the Libre-Office import...
-updateTheCsv(OUT_CSV_FILE,
-             latestPrices,
-             OUT_HTML_FILE)
-
-#If there was a backtest-result, show that.
-showResultLog()  
+profiled("readTickers",readTickers)
+profiled("readBets",readBets)
+markStartup("tickers and bets")
+if(Daemon):
+  runDaemon()
+else:
+  runOnce()
 
 